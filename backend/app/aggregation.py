@@ -1,8 +1,8 @@
 # backend/app/aggregation.py
-import geohash  # Import the library
 from typing import List, Dict, Optional
 from collections import defaultdict
 from .models import AirQualityReading, AggregatedAirQualityPoint # Import AggregatedAirQualityPoint
+from .geo import encode_geohashes
 
 # Define the structure for aggregated results per geohash cell
 # (Using AggregatedAirQualityPoint directly in the result list is cleaner,
@@ -105,18 +105,15 @@ def aggregate_by_geohash(
 
     aggregated_cells: Dict[str, AggregatedData] = defaultdict(AggregatedData)
 
-    for point in points:
-        if point.latitude is None or point.longitude is None:
-            continue # Skip points without coordinates
-
-        try:
-            # Calculate geohash using the *requested aggregation precision*
-            gh = geohash.encode(point.latitude, point.longitude, precision=precision)
-            aggregated_cells[gh].add_reading(point)
-        except Exception as e:
-            # Log error but continue processing other points
-            print(f"Could not process point for aggregation: {point}, Error: {e}") # Use logger in real app
-            continue
+    located = [p for p in points if p.latitude is not None and p.longitude is not None] # Skip points without coordinates
+    if not located:
+        return []
+
+    # Geohashes at the *requested aggregation precision* for all points in one vectorized pass
+    # (same cells as geohash.encode; no python-geohash needed)
+    cells = encode_geohashes([p.latitude for p in located], [p.longitude for p in located], precision)
+    for point, gh in zip(located, cells):
+        aggregated_cells[gh].add_reading(point)
 
     # Convert aggregated data into the desired output format
     result_list: List[AggregatedAirQualityPoint] = []
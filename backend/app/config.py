@@ -13,6 +13,11 @@ class Settings(BaseSettings):
     influxdb_token: str = "YourAdminAuthTokenHere"
     influxdb_org: str = "airquality_org"
     influxdb_bucket: str = "airquality_data"
+    influxdb_write_workers: int = 4 # Parallel requests used by write_air_quality_batch
+    influxdb_query_workers: int = 4 # Background queries (e.g. the speculative 50 km radius estimate)
+    influxdb_pool_maxsize: int = 64 # Kept-alive HTTP connections shared by all queries and writes; cover API threads + worker pools
+    influxdb_enable_gzip: bool = True # Compress query responses / write bodies
+    write_precision: str = "us" # Stored timestamp precision: "s", "ms", "us" (lossless for datetimes) or "ns"
 
     # RabbitMQ Configuration (Use alias to match .env/docker-compose setup)
     rabbitmq_host: str = "localhost" # Default for local, overridden by env var in docker
@@ -26,6 +31,16 @@ class Settings(BaseSettings):
     
     geohash_precision_storage: int = 5
 
+    # Density rollup InfluxDB task (5-minute sums/counts per geohash cell) used by long-window density queries
+    density_rollup_enabled: bool = True
+    density_rollup_backfill: str = "7d" # History rolled up once when the task is first created
+    density_query_shards: int = 4 # Parallel sub-queries for bboxes spanning many geohash cells
+
+    # Seconds an anomaly query result may be served from the in-process cache
+    anomaly_cache_ttl_seconds: int = 30
+    # Seconds density / recent-points results may be reused for identical map requests
+    query_cache_ttl_seconds: int = 30
+
     # Anomaly Detection Thresholds (Keep as is)
     threshold_pm25_hazardous: float = 250.0
     threshold_pm10_hazardous: float = 420.0
@@ -1,16 +1,30 @@
 # backend/app/db_client.py
-import geohash # Import the library
-from influxdb_client import InfluxDBClient, Point, WritePrecision
+from influxdb_client import InfluxDBClient, WritePrecision
 from influxdb_client.client.write_api import SYNCHRONOUS
 from influxdb_client.client.exceptions import InfluxDBError
+from influxdb_client.domain.dialect import Dialect
+from influxdb_client.domain.task_create_request import TaskCreateRequest
 from .config import get_settings
-from .models import AirQualityReading
-from typing import List, Optional, Set
+from typing import List, Optional
 import logging
 from datetime import datetime, timedelta, timezone
 from .models import AirQualityReading, Anomaly, PollutionDensity, TimeSeriesDataPoint # Add TimeSeriesDataPoint
-import json # Needed for query formatting
-from math import radians, cos, sin, sqrt, atan2
+from .geo import within_radius, grid_geohashes, encode_geohash, encode_geohashes
+import numpy as np
+from cachetools import TTLCache
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+import atexit
+import time
+from functools import lru_cache
+from math import isfinite, radians, cos
+import re
+from string import Template
+from pathlib import Path
+try:
+    from ciso8601 import parse_datetime as _parse_rfc3339 # Installed with influxdb-client[ciso]
+except ImportError:
+    _parse_rfc3339 = datetime.fromisoformat # C as well; accepts 'Z' and nanosecond digits on Python 3.11+
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
@@ -23,134 +37,625 @@ influx_token = settings.influxdb_token
 influx_org = settings.influxdb_org
 influx_bucket = settings.influxdb_bucket
 
-logger.info(f"Attempting to connect to InfluxDB at {influx_url} in org '{influx_org}'")
+# --- Client ---
+# One client (and one keep-alive connection pool) per process, created on first use rather than at import:
+# forked workers (uvicorn/gunicorn --workers) then each open their own sockets instead of inheriting the
+# parent's. close_influx_client() is for shutdown only.
+client = None
+write_api_blocking = None
+query_api = None
+_client_lock = Lock()
 
-try:
-    client = InfluxDBClient(url=influx_url, token=influx_token, org=influx_org, timeout=20_000)
-    write_api = client.write_api(write_options=SYNCHRONOUS)
-    query_api = client.query_api()
-    logger.info("InfluxDB client initialized.")
+def get_client() -> Optional[InfluxDBClient]:
+    """
+    Returns the shared InfluxDB client, creating it and the write/query APIs on the first call.
+    Returns None if it could not be created (the next call tries again).
+    """
+    global client, write_api_blocking, query_api
+    if client is not None:
+        return client
+    with _client_lock:
+        if client is not None: # Another thread created it while we waited
+            return client
+        logger.info(f"Attempting to connect to InfluxDB at {influx_url} in org '{influx_org}'")
+        try:
+            new_client = InfluxDBClient(
+                url=influx_url, token=influx_token, org=influx_org, timeout=20_000,
+                enable_gzip=settings.influxdb_enable_gzip,
+                connection_pool_maxsize=settings.influxdb_pool_maxsize
+            )
+            # Blocking writes: callers (the worker ACKs a message on success) need each request's outcome.
+            # Many readings at once go through write_air_quality_batch, one request per chunk.
+            write_api_blocking = new_client.write_api(write_options=SYNCHRONOUS)
+            query_api = new_client.query_api()
+            client = new_client # Published last: a non-None client means the APIs are set
+        except Exception as e:
+            logger.error(f"Failed to initialize InfluxDB client: {e}", exc_info=True)
+            write_api_blocking = query_api = None
+            return None
 
-    # Check connection / readiness (Updated Check)
-    try:
-        ready = client.ready()
-        if hasattr(ready, 'status') and ready.status == "ready": # Check status attribute
-            version_info = f" Version: {ready.version}" if hasattr(ready, 'version') else ""
-            logger.info(f"InfluxDB connection successful! Status: {ready.status}{version_info}")
-        elif hasattr(ready, 'status'):
-             logger.warning(f"InfluxDB ready check returned status: {ready.status}")
-        else:
-             logger.warning(f"InfluxDB ready check response object structure unexpected: {ready}")
+        # urllib3 opens (and later throws away) extra connections once the pool is exhausted; log the
+        # effective size so an undersized pool shows up next to the API/worker thread counts
+        pool_kw = client.api_client.rest_client.pool_manager.connection_pool_kw
+        logger.info(f"InfluxDB client initialized (keep-alive pool maxsize={pool_kw.get('maxsize')}, gzip={settings.influxdb_enable_gzip}).")
 
-    except Exception as e:
-         logger.error(f"Error checking InfluxDB readiness: {e}", exc_info=True)
+        # Check connection / readiness (Updated Check)
+        try:
+            ready = client.ready()
+            if hasattr(ready, 'status') and ready.status == "ready": # Check status attribute
+                version_info = f" Version: {ready.version}" if hasattr(ready, 'version') else ""
+                logger.info(f"InfluxDB connection successful! Status: {ready.status}{version_info}")
+            elif hasattr(ready, 'status'):
+                 logger.warning(f"InfluxDB ready check returned status: {ready.status}")
+            else:
+                 logger.warning(f"InfluxDB ready check response object structure unexpected: {ready}")
+        except Exception as e:
+             logger.error(f"Error checking InfluxDB readiness: {e}", exc_info=True)
+        return client
+
+# --- Line Protocol Helpers ---
+# Pollutant fields written for each reading, in line protocol field order
+POLLUTANT_FIELDS = ('pm25', 'pm10', 'no2', 'so2', 'o3')
+_POLLUTANT_FIELD_PREFIXES = tuple((k, k + "=") for k in POLLUTANT_FIELDS) # (attribute, 'key=') pairs built once
+# Pivoted columns read back for each reading, in unpacking order
+_READING_KEYS = ('latitude', 'longitude') + POLLUTANT_FIELDS
+_READING_KEY_INDEX = {k: i for i, k in enumerate(_READING_KEYS)}
+# Pivoted anomaly columns/tags read back, in unpacking order
+_ANOMALY_KEYS = ('latitude', 'longitude', 'parameter', 'id', 'value', 'description')
+# Columns of a density summary row (points plus a sum/count pair per pollutant)
+_DENSITY_SUMMARY_KEYS = ('points',) + tuple(f"{f}_{agg}" for f in POLLUTANT_FIELDS for agg in ("sum", "count"))
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# Timestamp precision of everything written (settings.write_precision). datetimes only carry microseconds,
+# so "us" is lossless and 3 digits shorter per line than "ns"; "ms"/"s" shorten it further but truncate,
+# and points of the same series (geohash cell) landing in the same unit overwrite each other.
+_WRITE_PRECISIONS = {
+    "s": (WritePrecision.S, timedelta(seconds=1)),
+    "ms": (WritePrecision.MS, timedelta(milliseconds=1)),
+    "us": (WritePrecision.US, timedelta(microseconds=1)),
+    "ns": (WritePrecision.NS, None),
+}
+if settings.write_precision not in _WRITE_PRECISIONS:
+    logger.warning(f"Unknown write_precision '{settings.write_precision}', using 'us'.")
+WRITE_PRECISION, _WRITE_UNIT = _WRITE_PRECISIONS.get(settings.write_precision, _WRITE_PRECISIONS["us"])
+
+def _to_ns(ts: datetime) -> int:
+    """ Converts a timezone-aware datetime to integer nanoseconds since the epoch (exact, no float rounding). """
+    return (ts - _EPOCH) // timedelta(microseconds=1) * 1000
+
+def _to_write_ts(ts: datetime) -> int:
+    """ Converts a timezone-aware datetime to an integer timestamp in WRITE_PRECISION units (exact integer math). """
+    if _WRITE_UNIT is None:
+        return _to_ns(ts)
+    return (ts - _EPOCH) // _WRITE_UNIT
+
+def _escape_tag(value: str) -> str:
+    """ Escapes a line protocol tag value (backslash, comma, equals sign, space). """
+    return value.replace("\\", "\\\\").replace(",", "\\,").replace("=", "\\=").replace(" ", "\\ ")
+
+def _escape_str_field(value: str) -> str:
+    """ Escapes a line protocol string field value (backslash, double quote) and wraps it in quotes. """
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+def _to_lp(reading: AirQualityReading, geohash_str: str, ts: int) -> Optional[str]:
+    """
+    Formats an AirQualityReading as a single line protocol string.
+    The geohash (base32, no escaping needed) is the only spatial tag and is required: every read path
+    selects series by geohash prefix. latitude/longitude are stored as float fields so series
+    cardinality grows with geohash cells, not with raw coordinates. `ts` is in WRITE_PRECISION units.
+    Returns None if the reading has no (finite) pollutant values to write.
+    """
+    fields = []
+    for k, prefix in _POLLUTANT_FIELD_PREFIXES:
+        v = getattr(reading, k)
+        if v is not None and isfinite(v): # NaN/inf are dropped here so queries never have to filter them
+            fields.append(prefix + repr(float(v)))
+    if not fields:
+        return None
+    return f"air_quality,geohash={geohash_str} latitude={float(reading.latitude)},longitude={float(reading.longitude)},{','.join(fields)} {ts}"
+
+def _anomaly_to_lp(anomaly: Anomaly, ts: int) -> str:
+    """
+    Formats an Anomaly as a single line protocol string for the 'air_quality_anomalies' measurement.
+    Like readings, latitude/longitude are float fields rather than tags (no per-coordinate series).
+    """
+    return (
+        f"air_quality_anomalies,id={_escape_tag(anomaly.id)},parameter={_escape_tag(anomaly.parameter)} "
+        f"latitude={float(anomaly.latitude)},longitude={float(anomaly.longitude)},"
+        f"value={float(anomaly.value)},description={_escape_str_field(anomaly.description)} {ts}"
+    )
 
+# --- Input Validation ---
+# Runs before any Flux string is built, so bad input fails fast without a server round trip
+# and nothing user-supplied can be spliced into a query unchecked.
+_DURATION_RE = re.compile(r'^(\d+(ns|us|ms|s|m|h|d|w|mo|y))+$') # Flux duration literal, e.g. '1h', '15m', '1h30m'
+_GEOHASH_RE = re.compile(r'^[0123456789bcdefghjkmnpqrstuvwxyz]{1,12}$')
+
+def _validate_bbox(min_lat: float, max_lat: float, min_lon: float, max_lon: float):
+    """ Raises ValueError if any bbox coordinate is NaN/inf, out of range, or min >= max. """
+    for name, value in (("min_lat", min_lat), ("max_lat", max_lat), ("min_lon", min_lon), ("max_lon", max_lon)):
+        if not isfinite(value):
+            raise ValueError(f"{name} must be a finite number, got {value}")
+    if not (-90 <= min_lat < max_lat <= 90):
+        raise ValueError(f"Invalid latitude range: {min_lat} -> {max_lat}")
+    if not (-180 <= min_lon < max_lon <= 180):
+        raise ValueError(f"Invalid longitude range: {min_lon} -> {max_lon}")
+
+def _validate_coordinates(lat: float, lon: float):
+    """ Raises ValueError if a single coordinate is NaN/inf or out of range. """
+    if not (isfinite(lat) and isfinite(lon) and -90 <= lat <= 90 and -180 <= lon <= 180):
+        raise ValueError(f"Invalid coordinates: {lat},{lon}")
+
+def _validate_duration(value: str, name: str = "window"):
+    """ Raises ValueError unless the value is a plain Flux duration literal. """
+    if not isinstance(value, str) or not _DURATION_RE.match(value):
+        raise ValueError(f"Invalid {name} duration: {value!r}")
+
+_DURATION_PART_RE = re.compile(r'(\d+)(ns|us|ms|s|mo|m|h|d|w|y)')
+_DURATION_UNIT_SECONDS = {
+    'ns': 1e-9, 'us': 1e-6, 'ms': 1e-3, 's': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800,
+    'mo': 30 * 86400, 'y': 365 * 86400, # Calendar units: close enough for choosing a query strategy
+}
+
+def _duration_seconds(value: str) -> float:
+    """ Length of a (validated) Flux duration literal in seconds, e.g. '1h30m' -> 5400. """
+    return sum(int(n) * _DURATION_UNIT_SECONDS[unit] for n, unit in _DURATION_PART_RE.findall(value))
+
+def _validate_limit(limit: int):
+    """ Raises ValueError unless limit is a positive integer. """
+    if isinstance(limit, bool) or not isinstance(limit, int) or limit <= 0:
+        raise ValueError(f"Invalid limit: {limit!r}")
+
+# --- Flux Query Templates ---
+# Built once at import. Query values are sent as bind parameters (query_api(..., params={...})),
+# which the client turns into `option <key> = <literal>` statements, so the queries reference them
+# as bare identifiers. Keys start with an underscore so they can never shadow a Flux builtin
+# (`window`, `limit`, `start`, ...). Durations arrive as strings and are converted with duration(v:).
+# The query text never changes between calls and nothing is spliced into it. Only the geohash prefix
+# regexes are substituted ($prefix/$prefixes), because storage can only push down a regex literal;
+# those are generated internally, never user input.
+_RAW_BBOX_FLUX = Template('''
+        import "date"
+
+        from(bucket: _bucket)
+          |> range(start: date.sub(d: duration(v: _window), from: now()))
+          // Narrowest filters first: measurement + field whitelist can be pushed down to storage,
+          // so only the columns we actually read ever reach the pivot
+          |> filter(fn: (r) =>
+                 r["_measurement"] == "air_quality" and
+                 (r["_field"] == "latitude" or r["_field"] == "longitude" or
+                  r["_field"] == "pm25" or r["_field"] == "pm10" or r["_field"] == "no2" or
+                  r["_field"] == "so2" or r["_field"] == "o3")
+             )
+          // Only series tagged with a geohash cell overlapping the bbox (indexed tag filter, no full scan)
+          |> filter(fn: (r) => r["geohash"] =~ /^($prefixes)/)
+          |> filter(fn: (r) => not exists r.latitude) // Skip legacy points that stored lat/lon as string tags
+          // No per-row numeric/NaN check: every field is a typed float and NaN is never written (see _to_lp)
+$downsample
+          // Pivot fields (pollutants + latitude/longitude) into columns
+          |> pivot(
+                rowKey:["_time", "geohash"], // geohash is the only spatial tag
+                columnKey: ["_field"],
+                valueColumn: "_value"
+             )
+          // latitude/longitude are float fields now, so filter the bbox directly (no map/float cast)
+          |> filter(fn: (r) =>
+                 exists r.latitude and exists r.longitude and
+                 r.latitude >= _min_lat and r.latitude <= _max_lat and
+                 r.longitude >= _min_lon and r.longitude <= _max_lon
+             )
+          // Merge the per-cell tables first: limit() applies per table, so without this up to limit x cells rows come back
+          |> group()
+          |> sort(columns: ["_time"], desc: true) // Newest points first, so the cap keeps the most recent ones
+          |> limit(n: _limit) // Apply limit
+          // Only the columns parsed client-side go on the wire (meta/tag columns are never read back)
+          |> keep(columns: ["_time", "latitude", "longitude", "pm25", "pm10", "no2", "so2", "o3"])
+''')
+
+_DENSITY_FLUX = Template('''
+        import "date"
+
+        from(bucket: _bucket)
+          |> range(start: date.sub(d: duration(v: _window), from: now()))
+          |> filter(fn: (r) =>
+                 r["_measurement"] == "air_quality" and
+                 (r["_field"] == "latitude" or r["_field"] == "longitude" or
+                  r["_field"] == "pm25" or r["_field"] == "pm10" or r["_field"] == "no2" or
+                  r["_field"] == "so2" or r["_field"] == "o3")
+             )
+          // Only series tagged with a geohash cell overlapping the bbox (indexed tag filter, no full scan)
+          |> filter(fn: (r) => r["geohash"] =~ /^($prefixes)/)
+          |> filter(fn: (r) => not exists r.latitude) // Skip legacy points that stored lat/lon as string tags
+          |> pivot(rowKey:["_time", "geohash"], columnKey: ["_field"], valueColumn: "_value")
+          |> filter(fn: (r) =>
+                 exists r.latitude and exists r.longitude and
+                 r.latitude >= _min_lat and r.latitude <= _max_lat and
+                 r.longitude >= _min_lon and r.longitude <= _max_lon
+             )
+          // Sum and count every pollutant in one pass over the points in the bbox: a single row comes back
+          |> group()
+          |> reduce(
+                identity: {
+                    points: 0,
+                    pm25_sum: 0.0, pm25_count: 0, pm10_sum: 0.0, pm10_count: 0, no2_sum: 0.0, no2_count: 0,
+                    so2_sum: 0.0, so2_count: 0, o3_sum: 0.0, o3_count: 0
+                },
+                fn: (r, accumulator) => ({
+                    points: accumulator.points + 1,
+                    pm25_sum: if exists r.pm25 then accumulator.pm25_sum + float(v: r.pm25) else accumulator.pm25_sum,
+                    pm25_count: if exists r.pm25 then accumulator.pm25_count + 1 else accumulator.pm25_count,
+                    pm10_sum: if exists r.pm10 then accumulator.pm10_sum + float(v: r.pm10) else accumulator.pm10_sum,
+                    pm10_count: if exists r.pm10 then accumulator.pm10_count + 1 else accumulator.pm10_count,
+                    no2_sum: if exists r.no2 then accumulator.no2_sum + float(v: r.no2) else accumulator.no2_sum,
+                    no2_count: if exists r.no2 then accumulator.no2_count + 1 else accumulator.no2_count,
+                    so2_sum: if exists r.so2 then accumulator.so2_sum + float(v: r.so2) else accumulator.so2_sum,
+                    so2_count: if exists r.so2 then accumulator.so2_count + 1 else accumulator.so2_count,
+                    o3_sum: if exists r.o3 then accumulator.o3_sum + float(v: r.o3) else accumulator.o3_sum,
+                    o3_count: if exists r.o3 then accumulator.o3_count + 1 else accumulator.o3_count
+                })
+             )
+''')
+
+_DENSITY_ROLLUP_FLUX = Template('''
+        import "date"
+
+        // Complete rollup windows (see tasks/density_rollup.flux): one row per geohash cell and 5 minutes.
+        // A cell window counts as inside the bbox when the mean position of its points is.
+        rollup = from(bucket: _bucket)
+          |> range(start: date.sub(d: duration(v: _window), from: now()), stop: _rollup_stop)
+          |> filter(fn: (r) => r["_measurement"] == "air_quality_density_geo5")
+          |> filter(fn: (r) => r["geohash"] =~ /^($prefixes)/)
+          |> pivot(rowKey:["_time", "geohash"], columnKey: ["_field"], valueColumn: "_value")
+          |> filter(fn: (r) =>
+                 exists r.latitude_sum and exists r.latitude_count and r.latitude_count > 0.0 and
+                 exists r.longitude_sum and exists r.longitude_count and r.longitude_count > 0.0
+             )
+          |> map(fn: (r) => ({r with latitude: r.latitude_sum / r.latitude_count, longitude: r.longitude_sum / r.longitude_count}))
+          |> filter(fn: (r) =>
+                 r.latitude >= _min_lat and r.latitude <= _max_lat and
+                 r.longitude >= _min_lon and r.longitude <= _max_lon
+             )
+          |> group()
+          |> reduce(
+                identity: {
+                    points: 0,
+                    pm25_sum: 0.0, pm25_count: 0, pm10_sum: 0.0, pm10_count: 0, no2_sum: 0.0, no2_count: 0,
+                    so2_sum: 0.0, so2_count: 0, o3_sum: 0.0, o3_count: 0
+                },
+                fn: (r, accumulator) => ({
+                    points: accumulator.points + int(v: r.latitude_count),
+                    pm25_sum: if exists r.pm25_sum then accumulator.pm25_sum + r.pm25_sum else accumulator.pm25_sum,
+                    pm25_count: if exists r.pm25_count then accumulator.pm25_count + int(v: r.pm25_count) else accumulator.pm25_count,
+                    pm10_sum: if exists r.pm10_sum then accumulator.pm10_sum + r.pm10_sum else accumulator.pm10_sum,
+                    pm10_count: if exists r.pm10_count then accumulator.pm10_count + int(v: r.pm10_count) else accumulator.pm10_count,
+                    no2_sum: if exists r.no2_sum then accumulator.no2_sum + r.no2_sum else accumulator.no2_sum,
+                    no2_count: if exists r.no2_count then accumulator.no2_count + int(v: r.no2_count) else accumulator.no2_count,
+                    so2_sum: if exists r.so2_sum then accumulator.so2_sum + r.so2_sum else accumulator.so2_sum,
+                    so2_count: if exists r.so2_count then accumulator.so2_count + int(v: r.so2_count) else accumulator.so2_count,
+                    o3_sum: if exists r.o3_sum then accumulator.o3_sum + r.o3_sum else accumulator.o3_sum,
+                    o3_count: if exists r.o3_count then accumulator.o3_count + int(v: r.o3_count) else accumulator.o3_count
+                })
+             )
 
-except Exception as e:
-    logger.error(f"Failed to initialize InfluxDB client: {e}", exc_info=True)
-    client = None
-    write_api = None
-    query_api = None
+        // Raw points newer than the last rollup window, aggregated exactly like _DENSITY_FLUX
+        recent = from(bucket: _bucket)
+          |> range(start: _cutoff)
+          |> filter(fn: (r) =>
+                 r["_measurement"] == "air_quality" and
+                 (r["_field"] == "latitude" or r["_field"] == "longitude" or
+                  r["_field"] == "pm25" or r["_field"] == "pm10" or r["_field"] == "no2" or
+                  r["_field"] == "so2" or r["_field"] == "o3")
+             )
+          |> filter(fn: (r) => r["geohash"] =~ /^($prefixes)/)
+          |> filter(fn: (r) => not exists r.latitude) // Skip legacy points that stored lat/lon as string tags
+          |> pivot(rowKey:["_time", "geohash"], columnKey: ["_field"], valueColumn: "_value")
+          |> filter(fn: (r) =>
+                 exists r.latitude and exists r.longitude and
+                 r.latitude >= _min_lat and r.latitude <= _max_lat and
+                 r.longitude >= _min_lon and r.longitude <= _max_lon
+             )
+          |> group()
+          |> reduce(
+                identity: {
+                    points: 0,
+                    pm25_sum: 0.0, pm25_count: 0, pm10_sum: 0.0, pm10_count: 0, no2_sum: 0.0, no2_count: 0,
+                    so2_sum: 0.0, so2_count: 0, o3_sum: 0.0, o3_count: 0
+                },
+                fn: (r, accumulator) => ({
+                    points: accumulator.points + 1,
+                    pm25_sum: if exists r.pm25 then accumulator.pm25_sum + float(v: r.pm25) else accumulator.pm25_sum,
+                    pm25_count: if exists r.pm25 then accumulator.pm25_count + 1 else accumulator.pm25_count,
+                    pm10_sum: if exists r.pm10 then accumulator.pm10_sum + float(v: r.pm10) else accumulator.pm10_sum,
+                    pm10_count: if exists r.pm10 then accumulator.pm10_count + 1 else accumulator.pm10_count,
+                    no2_sum: if exists r.no2 then accumulator.no2_sum + float(v: r.no2) else accumulator.no2_sum,
+                    no2_count: if exists r.no2 then accumulator.no2_count + 1 else accumulator.no2_count,
+                    so2_sum: if exists r.so2 then accumulator.so2_sum + float(v: r.so2) else accumulator.so2_sum,
+                    so2_count: if exists r.so2 then accumulator.so2_count + 1 else accumulator.so2_count,
+                    o3_sum: if exists r.o3 then accumulator.o3_sum + float(v: r.o3) else accumulator.o3_sum,
+                    o3_count: if exists r.o3 then accumulator.o3_count + 1 else accumulator.o3_count
+                })
+             )
+
+        // Same columns on both sides: add the (at most two) summary rows together
+        union(tables: [rollup, recent])
+          |> reduce(
+                identity: {
+                    points: 0,
+                    pm25_sum: 0.0, pm25_count: 0, pm10_sum: 0.0, pm10_count: 0, no2_sum: 0.0, no2_count: 0,
+                    so2_sum: 0.0, so2_count: 0, o3_sum: 0.0, o3_count: 0
+                },
+                fn: (r, accumulator) => ({
+                    points: accumulator.points + r.points,
+                    pm25_sum: accumulator.pm25_sum + r.pm25_sum, pm25_count: accumulator.pm25_count + r.pm25_count,
+                    pm10_sum: accumulator.pm10_sum + r.pm10_sum, pm10_count: accumulator.pm10_count + r.pm10_count,
+                    no2_sum: accumulator.no2_sum + r.no2_sum, no2_count: accumulator.no2_count + r.no2_count,
+                    so2_sum: accumulator.so2_sum + r.so2_sum, so2_count: accumulator.so2_count + r.so2_count,
+                    o3_sum: accumulator.o3_sum + r.o3_sum, o3_count: accumulator.o3_count + r.o3_count
+                })
+             )
+''')
+
+_RECENT_POINTS_FLUX = '''
+        import "date"
+
+        from(bucket: _bucket)
+          |> range(start: date.sub(d: duration(v: _window), from: now()))
+          // Measurement + field whitelist before last(), so storage pushes the filter down
+          |> filter(fn: (r) =>
+                 r["_measurement"] == "air_quality" and
+                 (r["_field"] == "latitude" or r["_field"] == "longitude" or
+                  r["_field"] == "pm25" or r["_field"] == "pm10" or r["_field"] == "no2" or
+                  r["_field"] == "so2" or r["_field"] == "o3")
+             )
+          |> filter(fn: (r) => not exists r.latitude) // Skip legacy points that stored lat/lon as string tags
+          |> last() // Aggregated in storage: only the latest value of each field in each geohash cell comes back
+          // Pivot within each cell's table (series are already grouped per geohash). Fields whose last value is
+          // older than the cell's latest reading land in their own rows, so keep only the newest row: the latest
+          // reading with exactly the fields it was written with (lat/lon are part of every point)
+          |> pivot(rowKey:["_time", "geohash"], columnKey: ["_field"], valueColumn: "_value")
+          |> sort(columns: ["_time"], desc: true)
+          |> limit(n: 1)
+          |> group() // Then merge for the global limit
+          |> limit(n: _limit) // Limit the number of distinct locations returned
+          |> keep(columns: ["_time", "latitude", "longitude", "pm25", "pm10", "no2", "so2", "o3"]) // Only what is read back
+'''
+
+_ANOMALIES_FLUX = '''
+        from(bucket: _bucket)
+          |> range(start: _start, stop: _stop)
+          |> filter(fn: (r) => r["_measurement"] == "air_quality_anomalies")
+          // CORRECTED FILTER: Ensure necessary TAGS exist, and the FIELD is one we will pivot.
+          |> filter(fn: (r) => exists r.parameter and exists r.id) // Check tags
+          // latitude/longitude are float fields (older anomalies carry them as tags, which pivot keeps as group key columns)
+          |> filter(fn: (r) => r["_field"] == "value" or r["_field"] == "description" or r["_field"] == "latitude" or r["_field"] == "longitude")
+          // Pivot includes tags needed to uniquely identify the anomaly event row
+          |> pivot(rowKey:["_time", "id", "parameter"], columnKey: ["_field"], valueColumn: "_value")
+          // Optional: Add a filter *after* pivot if you STRICTLY require both value and description to be present
+          // |> filter(fn: (r) => exists r.value and exists r.description)
+          |> keep(columns: ["_time", "id", "parameter", "latitude", "longitude", "value", "description"]) // Only what is read back
+          |> sort(columns: ["_time"], desc: true) // Optional: sort by time descending
+'''
+
+_LOCATION_HISTORY_FLUX = '''
+        import "date"
+
+        from(bucket: _bucket)
+          |> range(start: date.sub(d: duration(v: _window), from: now()))
+          |> filter(fn: (r) => r["_measurement"] == "air_quality")
+          |> filter(fn: (r) => r["geohash"] == _geohash) // Filter by the specific geohash tag
+          |> filter(fn: (r) => r["_field"] == _parameter) // Filter by the specific parameter field
+          // No per-row numeric/NaN check: pollutant fields are typed floats and NaN is never written (see _to_lp)
+          // Aggregate into time windows (e.g., calculate the mean every 10 minutes)
+          |> aggregateWindow(every: duration(v: _every), fn: mean, createEmpty: false)
+          |> group() // Merge any series in the cell into one table so the sort below is global
+          |> keep(columns: ["_time", "_value"]) // Only what is read back
+          |> sort(columns: ["_time"]) // Ascending by time (cheap on the already aggregated output)
+          |> yield(name: "mean_values")
+'''
+
+_LATEST_CELL_FLUX = Template('''
+        import "date"
+
+        from(bucket: _bucket)
+          |> range(start: date.sub(d: duration(v: _window), from: now()))
+          |> filter(fn: (r) => r["_measurement"] == "air_quality")
+          |> filter(fn: (r) => r["geohash"] =~ /^$prefix/) // The target cell's neighborhood (prefix regex stays a literal for pushdown)
+          |> last() // Get the most recent point for each field in each cell (no pivot: rows are keyed by geohash/_field client-side)
+          |> keep(columns: ["_time", "_value", "_field", "geohash"]) // Only what is read back
+''')
+
+_RADIUS_FLUX = Template('''
+        import "date"
+
+        from(bucket: _bucket)
+          |> range(start: date.sub(d: duration(v: _window), from: now()))
+          |> filter(fn: (r) =>
+                 r["_measurement"] == "air_quality" and
+                 (r["_field"] == "latitude" or r["_field"] == "longitude" or
+                  r["_field"] == "pm25" or r["_field"] == "pm10" or r["_field"] == "no2" or
+                  r["_field"] == "so2" or r["_field"] == "o3")
+             )
+          // Only series whose geohash tag falls in one of the cells covering the 50 km area
+          |> filter(fn: (r) => r["geohash"] =~ /^($prefixes)/)
+          |> filter(fn: (r) => not exists r.latitude) // Skip legacy points that stored lat/lon as string tags
+          // One summary row per geohash cell and field (sum, count, latest time) instead of every raw point
+          |> group(columns: ["geohash", "_field"])
+          |> reduce(
+                identity: {sum: 0.0, count: 0, latest: time(v: 0)},
+                fn: (r, accumulator) => ({
+                    sum: accumulator.sum + float(v: r._value),
+                    count: accumulator.count + 1,
+                    latest: if r._time > accumulator.latest then r._time else accumulator.latest
+                })
+             )
+''')
+
+def _compile_geohash_filter(hashes) -> str:
+    """
+    Builds a compact regex alternation (body only, no anchors) matching any of the given geohash
+    prefixes, all of one precision. Shared leading characters are factored out and sibling cells
+    collapse into a character class, e.g. [sxk9, sxkc, sxm1] -> "s(x(k[9c]|m1))", which keeps the
+    query body small and lets the regex engine reject most series after a character or two.
+    A prefix whose 32 children are all present collapses to the prefix itself ("" when that is
+    the whole set, i.e. match everything).
+    """
+    branches = {}
+    for h in set(hashes):
+        branches.setdefault(h[:1], set()).add(h[1:])
+    leaves, parts = [], []
+    for c, rest in sorted(branches.items()):
+        sub = "" if rest == {""} else _compile_geohash_filter(rest)
+        if sub:
+            parts.append(c + (f"({sub})" if "|" in sub else sub))
+        else:
+            leaves.append(c) # Either a cell itself or a fully covered parent
+    if len(leaves) == 32:
+        return ""
+    if leaves:
+        parts.insert(0, leaves[0] if len(leaves) == 1 else "[" + "".join(leaves) + "]")
+    return "|".join(parts)
+
+
+# The substituted texts are pure functions of the prefixes, and repeated views hit the same cells
+@lru_cache(maxsize=2048)
+def _build_radius_flux(prefixes: tuple) -> str:
+    return _RADIUS_FLUX.substitute(prefixes=_compile_geohash_filter(prefixes))
+
+@lru_cache(maxsize=2048)
+def _build_latest_cell_flux(prefix: str) -> str:
+    return _LATEST_CELL_FLUX.substitute(prefix=prefix)
+
+# Optional downsampling step for raw bbox queries: series are per geohash cell and field, so this averages
+# each cell's values (position included) per window in storage before the pivot
+_RAW_BBOX_DOWNSAMPLE = "          |> aggregateWindow(every: duration(v: _every), fn: mean, createEmpty: false)"
+
+@lru_cache(maxsize=2048)
+def _build_raw_bbox_flux(prefixes: str, downsample: bool = False) -> str:
+    return _RAW_BBOX_FLUX.substitute(prefixes=prefixes, downsample=_RAW_BBOX_DOWNSAMPLE if downsample else "")
+
+@lru_cache(maxsize=2048)
+def _build_density_flux(prefixes: str) -> str:
+    return _DENSITY_FLUX.substitute(prefixes=prefixes)
+
+@lru_cache(maxsize=2048)
+def _build_density_rollup_flux(prefixes: str) -> str:
+    return _DENSITY_ROLLUP_FLUX.substitute(prefixes=prefixes)
+
+# --- Plain CSV Queries ---
+# For the reading queries (raw bbox points for the heatmap, recent points), ask for CSV without
+# annotation rows and parse only the columns we need, skipping the client's typed FluxRecord parsing.
+_CSV_NO_ANNOTATIONS = Dialect(header=True, annotations=[], delimiter=",", comment_prefix="#", date_time_format="RFC3339Nano")
+# Row timestamps are parsed with _parse_rfc3339 (ciso8601, else datetime.fromisoformat; see imports)
+# rather than the client's date helper, whose fallback without ciso8601 is dateutil (~500x slower)
+
+def _query_csv_rows(flux_query: str, flux_params: dict):
+    """
+    Runs a query with the annotation-free CSV dialect and yields (columns, row) for every data row,
+    where `columns` maps column name -> index in the (all-string) row. Empty strings are nulls.
+    """
+    columns = None
+    for row in query_api.query_csv(query=flux_query, org=influx_org, dialect=_CSV_NO_ANNOTATIONS, params=flux_params):
+        if not row or row == [""]:
+            continue # Blank line between tables
+        if "_time" in row:
+            columns = {name: i for i, name in enumerate(row)} # Header (repeated when the table schema changes)
+            continue
+        if columns is not None:
+            yield columns, row
+
+def _iter_reading_rows(flux_query: str, flux_params: dict):
+    """
+    Yields (row, time string, values) for every row of a pivoted reading query, where `values` holds
+    the _READING_KEYS cells as strings (None when the column is missing or the cell is empty).
+    Column positions are resolved once per table header, not per row.
+    """
+    header = None
+    for columns, row in _query_csv_rows(flux_query, flux_params):
+        if columns is not header:
+            header = columns
+            time_i = columns["_time"]
+            key_is = [columns.get(k) for k in _READING_KEYS]
+        yield row, row[time_i], [row[i] or None if i is not None else None for i in key_is]
+
+def _reading_from_csv(record_time: str, values) -> AirQualityReading:
+    """
+    Builds a reading from _iter_reading_rows output (lat/lon must be present). Raises ValueError/TypeError
+    on unparsable cells. The data was validated at ingest and timestamps are UTC, so model_construct
+    skips re-running the validators for every row.
+    """
+    lat_v, lon_v, pm25_v, pm10_v, no2_v, so2_v, o3_v = values
+    return AirQualityReading.model_construct(
+        latitude=float(lat_v),
+        longitude=float(lon_v),
+        timestamp=_parse_rfc3339(record_time),
+        pm25=None if pm25_v is None else float(pm25_v),
+        pm10=None if pm10_v is None else float(pm10_v),
+        no2=None if no2_v is None else float(no2_v),
+        so2=None if so2_v is None else float(so2_v),
+        o3=None if o3_v is None else float(o3_v),
+    )
 
 def query_raw_points_in_bbox(
     min_lat: float, max_lat: float, min_lon: float, max_lon: float,
-    window: str = "1h", limit: int = 5000
+    window: str = "1h", limit: int = 5000, aggregate_every: Optional[str] = None
 ) -> List[AirQualityReading]:
     """
     Queries raw (unaggregated) air quality readings within a given bounding box
     and time window. Returns a list of AirQualityReading objects.
     A limit is applied to prevent excessive data retrieval.
+    With `aggregate_every` (e.g. '5m'), each geohash cell is averaged per window server-side
+    instead, returning one reading per cell and window (timestamped at the window end).
     FIXED: Handles potential float conversion errors before filtering.
     """
-    if not query_api:
+    if get_client() is None:
         logger.error("InfluxDB query_api not available for bbox query.")
         return []
 
-    if min_lat >= max_lat or min_lon >= max_lon:
-        logger.warning(f"Invalid bounding box received: {min_lat},{min_lon} -> {max_lat},{max_lon}")
+    try:
+        _validate_bbox(min_lat, max_lat, min_lon, max_lon)
+        _validate_duration(window)
+        _validate_limit(limit)
+        if aggregate_every is not None:
+            _validate_duration(aggregate_every, "aggregate_every")
+    except ValueError as e:
+        logger.warning(f"Rejected raw points bbox query: {e}")
         return []
 
-    # Flux query - FIXED
-    flux_query = f'''
-        import "math"
-        import "types"
-
-        from(bucket: "{influx_bucket}")
-          |> range(start: -{window})
-          |> filter(fn: (r) => r["_measurement"] == "air_quality")
-          |> filter(fn: (r) => exists r.latitude and exists r.longitude) // Ensure tags exist
-          // Map tags to potential floats. Conversion errors might result in null or error state.
-          |> map(fn: (r) => ({{ r with
-                latitude_float: float(v: r.latitude),
-                longitude_float: float(v: r.longitude)
-             }}))
-          // *** FIX: Add filter *after* map to ensure conversion resulted in numeric types ***
-          |> filter(fn: (r) =>
-                 types.isNumeric(v: r.latitude_float) and
-                 types.isNumeric(v: r.longitude_float)
-             )
-          // Now, safely filter by the numeric lat/lon ranges
-          |> filter(fn: (r) =>
-                 r.latitude_float >= {min_lat} and r.latitude_float <= {max_lat} and
-                 r.longitude_float >= {min_lon} and r.longitude_float <= {max_lon}
-             )
-          // Filter the actual measurement value (_value column)
-          |> filter(fn: (r) => types.isNumeric(v: r._value) and not math.isNaN(f: r._value))
-          // Pivot fields into columns
-          |> pivot(
-                rowKey:["_time", "latitude", "longitude", "geohash"], // Keep original tags + geohash
-                columnKey: ["_field"],
-                valueColumn: "_value"
-             )
-          |> limit(n: {limit}) // Apply limit
-    '''
+    flux_query = _build_raw_bbox_flux(_bbox_geohash_filter(min_lat, max_lat, min_lon, max_lon), aggregate_every is not None)
+    flux_params = {
+        "_bucket": influx_bucket, "_window": window, "_limit": limit,
+        # Floats explicitly: an int bound would be sent as an integer literal and fail against float fields
+        "_min_lat": float(min_lat), "_max_lat": float(max_lat), "_min_lon": float(min_lon), "_max_lon": float(max_lon)
+    }
+    if aggregate_every is not None:
+        flux_params["_every"] = aggregate_every
     logger.debug(f"Executing FIXED Flux query for raw points in bbox (limit {limit}):\n{flux_query}")
 
     results: List[AirQualityReading] = []
     try:
-        tables = query_api.query(query=flux_query, org=influx_org)
-        if not tables:
+        # No dedup needed: rows are pivoted on (_time, geohash) and geohash is the only tag, so every
+        # row is a distinct point (the query used to carry lat/lon tags, which could split a point)
+        results_append = results.append
+
+        for row, record_time, values in _iter_reading_rows(flux_query, flux_params):
+            if values[0] is None or values[1] is None:
+                # This check might be redundant now due to the improved Flux filter, but keep for safety
+                logger.warning(f"Skipping record due to missing lat/lon fields after pivot/filter: {row}")
+                continue
+
+            # Only the conversions can fail on a well-formed row, so only they sit in the try
+            # (anything unexpected is handled once, around the whole query, below)
+            try:
+                reading = _reading_from_csv(record_time, values)
+            except (ValueError, TypeError) as e:
+                logger.error(f"Error processing raw point record (parsing/type error): {e} - Record: {row}", exc_info=False)
+                continue
+            results_append(reading)
+
+        if not results:
             logger.info(f"No raw points found in bbox [{min_lat},{min_lon} - {max_lat},{max_lon}] window {window}.")
             return []
 
-        processed_times = set()
-
-        for table in tables:
-            for record in table.records:
-                record_time = record.get_time()
-                point_key = (record_time, record.values.get("latitude"), record.values.get("longitude"))
-
-                if point_key in processed_times:
-                    continue
-                processed_times.add(point_key)
-
-                try:
-                    data = record.values
-                    lat_str = data.get("latitude")
-                    lon_str = data.get("longitude")
-
-                    if lat_str is None or lon_str is None:
-                        # This check might be redundant now due to the improved Flux filter, but keep for safety
-                        logger.warning(f"Skipping record due to missing lat/lon tag after pivot/filter: {data}")
-                        continue
-
-                    # Ensure conversion here matches the Pydantic model types
-                    reading = AirQualityReading(
-                        latitude=float(lat_str),
-                        longitude=float(lon_str),
-                        timestamp=record_time,
-                        pm25=data.get('pm25'), # Already pivoted, access directly
-                        pm10=data.get('pm10'),
-                        no2=data.get('no2'),
-                        so2=data.get('so2'),
-                        o3=data.get('o3'),
-                    )
-                    results.append(reading)
-                except (ValueError, TypeError, KeyError) as e:
-                    logger.error(f"Error processing raw point record (parsing/type error): {e} - Record: {record.values}", exc_info=False)
-                except Exception as e:
-                    logger.error(f"Unexpected error processing raw point record: {e} - Record: {record.values}", exc_info=True)
-
         logger.info(f"Retrieved {len(results)} raw points from bbox [{min_lat},{min_lon} - {max_lat},{max_lon}] window {window}.")
         return results
 
@@ -165,6 +670,19 @@ def query_raw_points_in_bbox(
         logger.error(f"Generic error querying raw points in bbox: {e}", exc_info=True)
         return []
 # --- Query Function for Multiple Points  (air_quality/points)--- DEPRECATED ---
+# --- Map Query Caches ---
+# Map panning and auto-refresh send the same density / recent-points requests within seconds of each
+# other; serve repeats from memory for a short TTL instead of re-running the query.
+_density_cache: TTLCache = TTLCache(maxsize=2048, ttl=settings.query_cache_ttl_seconds)
+_density_cache_lock = Lock()
+_recent_points_cache: TTLCache = TTLCache(maxsize=64, ttl=settings.query_cache_ttl_seconds)
+_recent_points_cache_lock = Lock()
+
+def validate_recent_points_params(limit: int, window: str):
+    """ Raises ValueError unless limit/window are valid for the recent points queries (lets routes answer 400). """
+    _validate_duration(window)
+    _validate_limit(limit)
+
 def query_recent_points(limit: int = 50, window: str = "1h") -> List[AirQualityReading]:
     """
     Queries the latest distinct air quality readings from different locations
@@ -172,65 +690,47 @@ def query_recent_points(limit: int = 50, window: str = "1h") -> List[AirQualityR
     This function retrieves *raw* points which can then be aggregated.
     It does not perform aggregation itself.
     """
-    if not query_api:
+    if get_client() is None:
         logger.error("InfluxDB query_api not available.")
         return []
 
-    # Flux query to get the last point for each lat/lon combination within the window
-    # Note: Grouping by lat/lon tags might be slow on large datasets without indices.
-    # Consider using geohash tag for grouping if performance is an issue.
-    flux_query = f'''
-        from(bucket: "{influx_bucket}")
-          |> range(start: -{window})
-          |> filter(fn: (r) => r["_measurement"] == "air_quality")
-          |> filter(fn: (r) => exists r.latitude and exists r.longitude) // Ensure coords exist
-          |> group(columns: ["latitude", "longitude"]) // Group by exact location
-          |> last() // Get the latest point in each group
-          |> group(columns: ["_measurement"]) // Ungroup before pivot
-          |> pivot(rowKey:["_time", "latitude", "longitude"], columnKey: ["_field"], valueColumn: "_value")
-          |> limit(n: {limit}) // Limit the number of distinct locations returned
-    '''
+    try:
+        validate_recent_points_params(limit, window)
+    except ValueError as e:
+        logger.warning(f"Rejected recent points query: {e}")
+        return []
+
+    cache_key = (window, limit)
+    with _recent_points_cache_lock:
+        cached = _recent_points_cache.get(cache_key)
+    if cached is not None:
+        logger.debug(f"Serving {len(cached)} recent points from cache for {cache_key}.")
+        return list(cached)
+
+    # Flux query to get the last point for each geohash cell within the window
+    # Series are keyed by the geohash tag (lat/lon are fields), so last() already works per cell and field.
+    flux_query = _RECENT_POINTS_FLUX
+    flux_params = {"_bucket": influx_bucket, "_window": window, "_limit": limit}
     logger.debug(f"Executing Flux query for recent points:\n{flux_query}")
 
     results: List[AirQualityReading] = []
     try:
-        tables = query_api.query(query=flux_query, org=influx_org)
-        if not tables:
-            return []
-
-        for table in tables:
-            for record in table.records:
-                try:
-                    data = record.values
-                    # Convert lat/lon tags back to float, handle potential errors
-                    lat_str = data.get("latitude")
-                    lon_str = data.get("longitude")
-                    if lat_str is None or lon_str is None:
-                        logger.warning(f"Skipping record due to missing lat/lon tag: {data}")
-                        continue
-                    lat = float(lat_str)
-                    lon = float(lon_str)
-
-                    reading = AirQualityReading(
-                        latitude=lat,
-                        longitude=lon,
-                        timestamp=record.get_time(), # Pivot keeps time
-                        pm25=data.get('pm25'),
-                        pm10=data.get('pm10'),
-                        no2=data.get('no2'),
-                        so2=data.get('so2'),
-                        o3=data.get('o3')
-                        # Add other potential fields here if needed
-                    )
-                    results.append(reading)
-                except (ValueError, TypeError) as e:
-                    logger.error(f"Error processing record for recent points (ValueError/TypeError): {e} - Record: {record.values}", exc_info=False)
-                    continue # Skip faulty record
-                except Exception as e:
-                    logger.error(f"Error processing record for recent points: {e} - Record: {record.values}", exc_info=True)
-                    continue # Skip faulty record
+        # Parse CSV rows as they stream off the response (no FluxRecord objects, no buffering of every table)
+        results_append = results.append
+        for row, record_time, values in _iter_reading_rows(flux_query, flux_params):
+            if values[0] is None or values[1] is None:
+                logger.warning(f"Skipping record due to missing lat/lon fields: {row}")
+                continue
+            try:
+                reading = _reading_from_csv(record_time, values)
+            except (ValueError, TypeError) as e:
+                logger.error(f"Error processing record for recent points (ValueError/TypeError): {e} - Record: {row}", exc_info=False)
+                continue # Skip faulty record
+            results_append(reading)
 
         logger.info(f"Retrieved {len(results)} recent points.")
+        with _recent_points_cache_lock:
+            _recent_points_cache[cache_key] = tuple(results)
         return results
 
     except InfluxDBError as e:
@@ -240,97 +740,155 @@ def query_recent_points(limit: int = 50, window: str = "1h") -> List[AirQualityR
         logger.error(f"Generic error querying recent points: {e}", exc_info=True)
         return []
 
+def query_recent_points_columnar(limit: int = 50, window: str = "1h") -> Optional[dict]:
+    """
+    Same rows as query_recent_points, returned as columns instead of one model per point:
+    {"timestamp": datetime64[ns] array (UTC), "latitude": float array, ..., "o3": float array}, missing
+    values as NaN. Meant for map rendering, where the arrays go straight to orjson (OPT_SERIALIZE_NUMPY).
+    Rows with unparsable cells are skipped. Returns None on error.
+    """
+    if get_client() is None:
+        logger.error("InfluxDB query_api not available.")
+        return None
+
+    try:
+        validate_recent_points_params(limit, window)
+    except ValueError as e:
+        logger.warning(f"Rejected recent points query: {e}")
+        return None
+
+    # Shares the recent-points cache (entries are read-only: the arrays are never modified after caching)
+    cache_key = ("columnar", window, limit)
+    with _recent_points_cache_lock:
+        cached = _recent_points_cache.get(cache_key)
+    if cached is not None:
+        logger.debug(f"Serving {len(cached['timestamp'])} recent points (columnar) from cache for {cache_key}.")
+        return dict(cached)
+
+    flux_params = {"_bucket": influx_bucket, "_window": window, "_limit": limit}
+    times = []
+    rows = [] # One tuple of floats per point, in _READING_KEYS order
+    nan = float("nan")
+    try:
+        for row, record_time, values in _iter_reading_rows(_RECENT_POINTS_FLUX, flux_params):
+            if values[0] is None or values[1] is None:
+                logger.warning(f"Skipping record due to missing lat/lon fields: {row}")
+                continue
+            # Convert per row so one bad cell skips its row instead of failing the whole array
+            try:
+                timestamp = np.datetime64(record_time.rstrip("Z"), "ns") # RFC3339 UTC; numpy wants it without the zone suffix
+                floats = tuple(nan if v is None else float(v) for v in values)
+            except (ValueError, TypeError) as e:
+                logger.error(f"Error processing record for recent points (columnar): {e} - Record: {row}", exc_info=False)
+                continue
+            times.append(timestamp)
+            rows.append(floats)
+
+        # (keys, points), C-contiguous so every column is a contiguous row that orjson can serialize
+        table = np.ascontiguousarray(np.array(rows, dtype=np.float64).reshape(len(rows), len(_READING_KEYS)).T)
+        result = {"timestamp": np.array(times, dtype="datetime64[ns]")}
+        for key, column in zip(_READING_KEYS, table):
+            result[key] = column
+        logger.info(f"Retrieved {len(times)} recent points (columnar).")
+        with _recent_points_cache_lock:
+            _recent_points_cache[cache_key] = result
+        return dict(result)
+
+    except InfluxDBError as e:
+        logger.error(f"InfluxDB Error querying recent points: {e}", exc_info=True)
+        return None
+    except Exception as e:
+        logger.error(f"Generic error querying recent points (columnar): {e}", exc_info=True)
+        return None
+
+
+# --- Anomaly Query Cache ---
+# Anomalies are rare and read-mostly (dashboards poll the same range), so results are kept
+# for a short TTL. Any new anomaly (written here or broadcast by the worker) clears the cache.
+_anomaly_cache: TTLCache = TTLCache(maxsize=64, ttl=settings.anomaly_cache_ttl_seconds)
+_anomaly_cache_lock = Lock()
+
+def _anomaly_cache_key(start_time: Optional[datetime], end_time: Optional[datetime]):
+    """ Normalizes a query range to UTC, second resolution, so near-identical "until now" requests share an entry. """
+    def norm(dt: Optional[datetime]) -> Optional[str]:
+        if dt is None:
+            return None
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=timezone.utc)
+        return dt.astimezone(timezone.utc).replace(microsecond=0).isoformat()
+    return (norm(start_time), norm(end_time))
+
+def invalidate_anomaly_cache():
+    """ Drops all cached anomaly query results. Call when a new anomaly is known to exist. """
+    with _anomaly_cache_lock:
+        _anomaly_cache.clear()
 
 # --- Query Function for Anomalies ---
 def query_anomalies_from_db(start_time: Optional[datetime] = None, end_time: Optional[datetime] = None) -> List[Anomaly]:
     """
     Queries detected anomalies stored in the 'air_quality_anomalies' measurement.
     NOTE: Requires anomalies to be detected and written separately.
+    Results are served from a short-lived in-process cache when available.
     """
-    if not query_api:
+    if get_client() is None:
         logger.error("InfluxDB query_api not available.")
         return []
 
-    # Default time range (e.g., last 24 hours) if not provided
-    if start_time is None and end_time is None:
-        range_filter = f'|> range(start: -24h)' # Default range is fine
-    elif start_time and end_time:
-         # Ensure timezone-aware before formatting
-         # CORRECTED: Remove manual '+ 'Z''
-         start_iso = start_time.astimezone(timezone.utc).isoformat()
-         end_iso = end_time.astimezone(timezone.utc).isoformat()
-         range_filter = f'|> range(start: {start_iso}, stop: {end_iso})'
-    elif start_time:
-         # CORRECTED: Remove manual '+ 'Z''
-         start_iso = start_time.astimezone(timezone.utc).isoformat()
-         range_filter = f'|> range(start: {start_iso})'
-    else: # Only end_time provided
-        # CORRECTED: Remove manual '+ 'Z''
-        end_iso = end_time.astimezone(timezone.utc).isoformat()
-        # Default start to 0 (beginning of Unix time) is suitable for InfluxDB
-        range_filter = f'|> range(start: 0, stop: {end_iso})'
-
-
-    # Flux query to get anomaly records
-    # Flux query to get anomaly records
-    flux_query = f'''
-        from(bucket: "{influx_bucket}")
-          {range_filter}
-          |> filter(fn: (r) => r["_measurement"] == "air_quality_anomalies")
-          // CORRECTED FILTER: Ensure necessary TAGS exist, and the FIELD is one we will pivot.
-          |> filter(fn: (r) => exists r.latitude and exists r.longitude and exists r.parameter and exists r.id) // Check tags
-          |> filter(fn: (r) => r["_field"] == "value" or r["_field"] == "description") // Check if field is one of the expected ones
-          // Pivot includes tags needed to uniquely identify the anomaly event row
-          |> pivot(rowKey:["_time", "id", "latitude", "longitude", "parameter"], columnKey: ["_field"], valueColumn: "_value")
-          // Optional: Add a filter *after* pivot if you STRICTLY require both value and description to be present
-          // |> filter(fn: (r) => exists r.value and exists r.description)
-          |> sort(columns: ["_time"], desc: true) // Optional: sort by time descending
-    '''
+    cache_key = _anomaly_cache_key(start_time, end_time)
+    with _anomaly_cache_lock:
+        cached = _anomaly_cache.get(cache_key)
+    if cached is not None:
+        logger.debug(f"Serving {len(cached)} anomalies from cache for range {cache_key}.")
+        return list(cached)
+
+    # Default time range (e.g., last 24 hours) if not provided; open ends fall back to 0 / now
+    if start_time is not None:
+        range_start = _to_utc(start_time)
+    else:
+        range_start = timedelta(hours=-24) if end_time is None else _EPOCH # Default start to 0 (beginning of Unix time) if only end_time is given
+    range_stop = _to_utc(end_time) if end_time is not None else datetime.now(timezone.utc)
+
+    # Flux query to get anomaly records (datetimes/timedeltas are sent as Flux time/duration literals)
+    flux_query = _ANOMALIES_FLUX
+    flux_params = {"_bucket": influx_bucket, "_start": range_start, "_stop": range_stop}
     logger.debug(f"Executing Flux query for anomalies:\n{flux_query}")
 
     results: List[Anomaly] = []
     try:
-        tables = query_api.query(query=flux_query, org=influx_org) # LINE 172 where error occurred
-        
-        if not tables:
-            logger.info("No anomalies found in the specified range.")
-            return []
+        # Stream records off the response instead of buffering every table first
+        results_append = results.append
+        for record in query_api.query_stream(query=flux_query, org=influx_org, params=flux_params):
+            data = record.values
+            # Tags are included in the pivoted rowKey and should be directly accessible
+            lat_v, lon_v, param_v, id_v, value_v, desc_v = map(data.get, _ANOMALY_KEYS)
+
+            # Basic check for required fields/tags after pivot
+            if lat_v is None or lon_v is None or param_v is None or id_v is None or value_v is None or desc_v is None:
+                logger.warning(f"Skipping anomaly record due to missing fields/tags after pivot: {data}")
+                continue
 
-        for table in tables:
-            for record in table.records:
-                 try:
-                    data = record.values
-                    # Tags are included in the pivoted rowKey and should be directly accessible
-                    lat_str = data.get("latitude")
-                    lon_str = data.get("longitude")
-                    param_str = data.get("parameter")
-                    id_str = data.get("id")
-                    val_float = data.get("value") # This is a field from pivot
-                    desc_str = data.get("description") # This is a field from pivot
-
-                    # Basic check for required fields/tags after pivot
-                    if None in [lat_str, lon_str, param_str, id_str, val_float, desc_str]:
-                        logger.warning(f"Skipping anomaly record due to missing fields/tags after pivot: {data}")
-                        continue
-
-                    anomaly = Anomaly(
-                        id=str(id_str),
-                        latitude=float(lat_str),
-                        longitude=float(lon_str),
-                        timestamp=record.get_time(), # Get timestamp from record metadata
-                        parameter=str(param_str),
-                        value=float(val_float),
-                        description=str(desc_str)
-                    )
-                    results.append(anomaly)
-                 except (ValueError, TypeError, KeyError) as e: # Catch potential parsing errors
-                    logger.error(f"Error processing anomaly record (parsing/type error): {e} - Record: {record.values}", exc_info=False)
-                    continue # Skip faulty record
-                 except Exception as e:
-                    logger.error(f"Unexpected error processing anomaly record: {e} - Record: {record.values}", exc_info=True)
-                    continue # Skip faulty record
-
-        logger.info(f"Found {len(results)} anomalies.")
+            try:
+                # Trusted, already-typed values from our own bucket: skip per-row validation
+                anomaly = Anomaly.model_construct(
+                    id=str(id_v),
+                    latitude=float(lat_v),
+                    longitude=float(lon_v),
+                    timestamp=data.get("_time"),
+                    parameter=str(param_v),
+                    value=float(value_v),
+                    description=str(desc_v)
+                )
+            except (ValueError, TypeError) as e: # Catch potential parsing errors
+                logger.error(f"Error processing anomaly record (parsing/type error): {e} - Record: {data}", exc_info=False)
+                continue # Skip faulty record
+            results_append(anomaly)
+
+        if results:
+            logger.info(f"Found {len(results)} anomalies.")
+        else:
+            logger.info("No anomalies found in the specified range.")
+        with _anomaly_cache_lock: # Empty results are cached too
+            _anomaly_cache[cache_key] = tuple(results)
         return results
 
     except InfluxDBError as e:
@@ -348,30 +906,21 @@ def query_anomalies_from_db(start_time: Optional[datetime] = None, end_time: Opt
         return []
 def write_anomaly_data(anomaly: Anomaly):
     """Writes a detected Anomaly to InfluxDB."""
-    if not write_api:
+    if get_client() is None:
         logger.error("InfluxDB write_api not available for writing anomaly.")
         return False
 
     # Ensure timestamp is timezone-aware
-    if anomaly.timestamp.tzinfo is None:
-        timestamp_to_write = anomaly.timestamp.replace(tzinfo=timezone.utc)
-    else:
-        timestamp_to_write = anomaly.timestamp.astimezone(timezone.utc)
-
-    point = (
-        Point("air_quality_anomalies") # Different measurement name
-        .tag("latitude", str(anomaly.latitude)) # Tag for location
-        .tag("longitude", str(anomaly.longitude)) # Tag for location
-        .tag("parameter", anomaly.parameter) # Tag the parameter causing anomaly
-        .tag("id", anomaly.id) # Tag the unique ID for potential lookup/grouping
-        .field("value", anomaly.value) # Store the anomalous value
-        .field("description", anomaly.description) # Store the description
-        .time(timestamp_to_write, WritePrecision.MS)
-    )
+    timestamp_to_write = _to_utc(anomaly.timestamp)
+
+    line = _anomaly_to_lp(anomaly, _to_write_ts(timestamp_to_write))
 
     try:
-        write_api.write(bucket=influx_bucket, org=influx_org, record=point)
+        # Blocking write: the anomaly must be stored before the cache is invalidated, or a query in between
+        # would cache the stale result again
+        write_api_blocking.write(bucket=influx_bucket, org=influx_org, record=line, write_precision=WRITE_PRECISION)
         logger.info(f"Successfully wrote anomaly: {anomaly.id} - {anomaly.description}")
+        invalidate_anomaly_cache()
         return True
     except InfluxDBError as e:
         logger.error(f"InfluxDB Error writing anomaly data: {e}", exc_info=True)
@@ -379,98 +928,294 @@ def write_anomaly_data(anomaly: Anomaly):
     except Exception as e:
         logger.error(f"Generic error writing anomaly data: {e}", exc_info=True)
         return False
-# --- Helper: calculate_geohashes_for_bbox (FIXED) ---
-# Define the standard geohash base32 characters
-GEOHASH_BASE32_CHARS = "0123456789bcdefghjkmnpqrstuvwxyz"
 
-# --- Helper for BBox Geohash Calculation ---
-def calculate_geohashes_for_bbox(min_lat, max_lat, min_lon, max_lon, precision) -> List[str]:
+def write_anomalies(anomalies: List[Anomaly]) -> int:
     """
-    Calculates a list of geohash prefixes of the given precision
-    that cover the bounding box.
-    Uses a recursive approach for better coverage. (FIXED AGAIN - Recursion Logic)
+    Writes several detected Anomalies to InfluxDB in a single request (one line protocol payload)
+    and invalidates the anomaly cache once. Returns the number of anomalies written (all or none).
     """
+    if not anomalies:
+        return 0
+    if get_client() is None:
+        logger.error("InfluxDB write_api not available for writing anomalies.")
+        return 0
+
+    payload = "\n".join(_anomaly_to_lp(a, _to_write_ts(_to_utc(a.timestamp))) for a in anomalies).encode("utf-8")
     try:
-        import geohash
-    except ImportError:
-        logger.warning("Geohash library not available for bbox calculation.")
-        raise # Re-raise so the caller knows it failed
+        # Blocking for the same reason as write_anomaly_data: stored before the cache is invalidated
+        write_api_blocking.write(bucket=influx_bucket, org=influx_org, record=payload, write_precision=WRITE_PRECISION)
+        logger.info(f"Successfully wrote {len(anomalies)} anomalies in one request.")
+        invalidate_anomaly_cache()
+        return len(anomalies)
+    except InfluxDBError as e:
+        logger.error(f"InfluxDB Error writing {len(anomalies)} anomalies: {e}", exc_info=True)
+        return 0
+    except Exception as e:
+        logger.error(f"Generic error writing {len(anomalies)} anomalies: {e}", exc_info=True)
+        return 0
 
-    checked_hashes: Set[str] = set() # Keep track of hashes already processed to prevent re-work
-    hashes_in_bbox: Set[str] = set()
+# --- Helper: cached geohash encoding ---
+# Storage tags always come from geo's encoder, the same math as the bulk encode_geohashes: python-geohash
+# versions disagree at the edges (lat == 90 raises in some, is clamped in others), and a single write and
+# a bulk write of the same position must never get different tags.
+_encode_geohash_cached = lru_cache(maxsize=4096)(encode_geohash)
 
-    def check_hash(h: str):
-        # Avoid redundant checks and potential cycles (though cycles less likely with pure subdivision)
-        if h in checked_hashes:
-            return
-        checked_hashes.add(h)
+def _encode_geohash(lat: float, lon: float, precision: int) -> str:
+    """
+    Geohash encode with an LRU cache in front. Fixed sensors and dashboards polling the same tiles
+    repeat the exact same coordinates. Keyed on the exact position: snapping it would change tags
+    near cell edges, and bulk writes (geo.encode_geohashes) must produce the same tag.
+    """
+    return _encode_geohash_cached(lat, lon, precision)
 
-        try:
-            gh_bbox = geohash.bbox(h)
-        except Exception as e:
-            logger.debug(f"Could not decode geohash '{h}' during bbox check: {e}")
-            return
+# --- Helper: calculate_geohashes_for_bbox ---
+@lru_cache(maxsize=16)
+def _geohash_cell_size(precision: int):
+    """
+    Cell height/width in degrees for a geohash precision. Each character adds 5 bits,
+    interleaved starting with longitude, so longitude gets the extra bit on odd totals.
+    """
+    total_bits = 5 * precision
+    lat_bits = total_bits // 2
+    lon_bits = total_bits - lat_bits
+    return 180.0 / (1 << lat_bits), 360.0 / (1 << lon_bits)
+
+# --- Helper for BBox Geohash Calculation ---
+# Upper bound on the prefixes in a bbox query's geohash tag filter (the precision is lowered until it fits)
+BBOX_MAX_PREFIX_CELLS = 64
+
+def _bbox_grid(min_lat, max_lat, min_lon, max_lon, precision):
+    """ (row_start, row_end, col_start, col_end) of the grid cells at `precision` touched by the bbox. """
+    cell_lat, cell_lon = _geohash_cell_size(precision)
+    lat_cells = round(180.0 / cell_lat)
+    lon_cells = round(360.0 / cell_lon)
+    # Clamped so max_lat == 90 / max_lon == 180 stay in the last cell
+    return (
+        max(int((min_lat + 90.0) // cell_lat), 0),
+        min(int((max_lat + 90.0) // cell_lat), lat_cells - 1),
+        max(int((min_lon + 180.0) // cell_lon), 0),
+        min(int((max_lon + 180.0) // cell_lon), lon_cells - 1),
+    )
 
-        hash_min_lat, hash_max_lat = gh_bbox['s'], gh_bbox['n']
-        hash_min_lon, hash_max_lon = gh_bbox['w'], gh_bbox['e']
+def calculate_geohashes_for_bbox(min_lat, max_lat, min_lon, max_lon, precision) -> List[str]:
+    """
+    Calculates a list of geohashes of the given precision that cover the bounding box.
+    Cells form a regular lat/lon grid, so the covering cells are enumerated directly
+    (bit-interleaved from the cell row/column indices) instead of searching the geohash tree.
+    """
+    # Key the cache on the grid indices: every bbox that touches the same cells (e.g. repeated
+    # dashboard pans snapping to the same view) shares one entry, whatever its exact float edges
+    result = list(_grid_geohashes(*_bbox_grid(min_lat, max_lat, min_lon, max_lon, precision), precision))
+    logger.debug(f"Calculated {len(result)} geohash prefixes for bbox with precision {precision}")
+    return result
 
-        # Check for intersection between the geohash's bbox and the target bbox
-        intersects = (hash_min_lat <= max_lat and hash_max_lat >= min_lat and
-                      hash_min_lon <= max_lon and hash_max_lon >= min_lon)
+@lru_cache(maxsize=4096)
+def _grid_geohashes(row_start: int, row_end: int, col_start: int, col_end: int, precision: int) -> tuple:
+    """Geohashes (as a tuple, so the cached value can't be mutated) of a block of grid cells."""
+    return tuple(grid_geohashes(row_start, row_end, col_start, col_end, precision))
 
-        if not intersects:
-            return # This geohash (and its subdivisions) are outside the target area
+def _bbox_geohash_cells(min_lat, max_lat, min_lon, max_lon) -> tuple:
+    """
+    Geohash prefixes (row-major) covering every stored cell that can hold points in the bbox.
+    Uses the finest precision (up to storage precision) at which the bbox spans at most
+    BBOX_MAX_PREFIX_CELLS cells; precision 1 always fits (32 cells for the whole globe), so bbox
+    queries are always narrowed by the indexed tag instead of scanning the whole bucket.
+    """
+    for precision in range(settings.geohash_precision_storage, 0, -1):
+        row_start, row_end, col_start, col_end = _bbox_grid(min_lat, max_lat, min_lon, max_lon, precision)
+        if (row_end - row_start + 1) * (col_end - col_start + 1) <= BBOX_MAX_PREFIX_CELLS or precision == 1:
+            return _grid_geohashes(row_start, row_end, col_start, col_end, precision)
 
-        # If the hash is at the target precision and intersects, add it
-        if len(h) == precision:
-            hashes_in_bbox.add(h)
-            return
+def _bbox_geohash_filter(min_lat, max_lat, min_lon, max_lon) -> str:
+    """ Geohash tag regex (body, for /^(...)/) for the _bbox_geohash_cells of the bbox. """
+    return _compile_geohash_filter(_bbox_geohash_cells(min_lat, max_lat, min_lon, max_lon))
 
-        # If the hash intersects and is shorter than the target precision, subdivide and recurse
-        if len(h) < precision:
-            # *** FIX: Only subdivide the current hash, do not check neighbors here ***
-            for char in GEOHASH_BASE32_CHARS:
-                next_h = h + char
-                # No need to check length again, it will be checked in the recursive call
-                check_hash(next_h)
-
-    # Start check from a few points (same logic as before)
-    initial_hashes = set()
-    points_to_encode = [
-        ( (min_lat + max_lat) / 2, (min_lon + max_lon) / 2 ), # Center
-        (min_lat, min_lon), (min_lat, max_lon), (max_lat, min_lon), (max_lat, max_lon) # Corners
-    ]
-    start_precision = min(precision, 4) if precision > 1 else 1
-    for p_lat, p_lon in points_to_encode:
-        try:
-            if -90 <= p_lat <= 90 and -180 <= p_lon <= 180:
-                initial_hashes.add(geohash.encode(p_lat, p_lon, precision=start_precision))
-            else:
-                 logger.warning(f"Skipping invalid coordinate for initial hash: {p_lat},{p_lon}")
-        except Exception as e: logger.warning(f"Could not encode initial point {p_lat},{p_lon}: {e}")
 
-    if not initial_hashes:
-        logger.error(f"Could not generate any initial geohashes for bbox check: [{min_lat},{min_lon} to {max_lat},{max_lon}]")
-        # Fallback logic remains the same
+# --- Sharded Density Queries ---
+# Wide bboxes cover many cells and a single Flux query walks all of their series on one goroutine.
+# Splitting the cells into shards of neighboring cells lets InfluxDB scan them in parallel; each
+# shard returns its own sums/counts and the shards are added up client-side.
+DENSITY_SHARD_MIN_CELLS = 32 # Below this the extra round trips cost more than they save
+_density_pool = ThreadPoolExecutor(max_workers=max(1, settings.density_query_shards), thread_name_prefix="influx-density")
+atexit.register(_density_pool.shutdown, cancel_futures=True)
+
+def _density_shards(cells: tuple) -> List[str]:
+    """
+    Splits the (row-major) bbox cells into up to settings.density_query_shards contiguous runs and
+    returns each run's compiled regex. Contiguous runs share leading characters, so each stays compact.
+    """
+    if len(cells) < DENSITY_SHARD_MIN_CELLS or settings.density_query_shards < 2:
+        return [_compile_geohash_filter(cells)]
+    size = -(-len(cells) // settings.density_query_shards) # Ceiling division
+    return [_compile_geohash_filter(cells[i:i + size]) for i in range(0, len(cells), size)]
+
+def _query_density_summary(flux_query: str, flux_params: dict) -> Optional[dict]:
+    """ Runs one density query and returns its single summary row (None when no points matched). """
+    summary = None
+    for record in query_api.query_stream(query=flux_query, org=influx_org, params=flux_params):
+        summary = record.values
+    return summary
+
+def _merge_density_summaries(summaries) -> Optional[dict]:
+    """ Adds up the points and per-pollutant sums/counts of several shard summaries. """
+    merged = None
+    for summary in summaries:
+        if not summary:
+            continue
+        if merged is None:
+            merged = {key: summary.get(key) or 0 for key in _DENSITY_SUMMARY_KEYS}
+        else:
+            for key in _DENSITY_SUMMARY_KEYS:
+                merged[key] += summary.get(key) or 0
+    return merged
+
+
+# --- Density Rollup Task ---
+# An InfluxDB task (tasks/density_rollup.flux) pre-aggregates sums/counts per geohash cell and 5 minutes.
+# Density queries over long windows read those rows plus only the raw points newer than the last
+# complete rollup window, instead of every raw point in the window.
+DENSITY_ROLLUP_TASK_NAME = "density_rollup_geo5"
+DENSITY_ROLLUP_MIN_WINDOW_SECONDS = 3600 # Shorter windows hold few points: query them raw
+_ROLLUP_INTERVAL = timedelta(minutes=5)
+_ROLLUP_DELAY = timedelta(minutes=2) # Task offset (1m) + run time before a window's rows are in place
+_DENSITY_ROLLUP_TASK = Template((Path(__file__).parent / "tasks" / "density_rollup.flux").read_text())
+# Rollup state lives in the bucket, shared by every worker process: "backfill_started" when a backfill
+# begins, "backfilled" once it has completed. Only the latter makes the rollup readable.
+DENSITY_ROLLUP_STATE_MEASUREMENT = "air_quality_density_rollup_state"
+_ROLLUP_RECHECK_SECONDS = 60 # How often a process re-checks a rollup that is not ready yet (and retries a failed setup)
+_BACKFILL_STALE_AFTER = timedelta(hours=1) # A backfill started this long ago without completing is taken over
+_density_rollup_ready = False # Cached "backfilled" marker; once seen it stays set
+_rollup_checked_at = None # time.monotonic() of the last readiness check in this process
+_rollup_check_lock = Lock()
+_backfill_lock = Lock() # One backfill at a time per process
+_backfill_failed = False # This process's backfill failed: retry it on the next check instead of waiting for the takeover
+
+_ROLLUP_STATE_FLUX = '''
+        from(bucket: _bucket)
+          |> range(start: 1970-01-01T00:00:00Z)
+          |> filter(fn: (r) => r["_measurement"] == "air_quality_density_rollup_state")
+          |> last()
+          |> keep(columns: ["_time", "_field"])
+'''
+
+def _rollup_state() -> dict:
+    """ Latest time of each rollup state marker in the bucket, e.g. {'backfill_started': t, 'backfilled': t}. """
+    records = query_api.query_stream(query=_ROLLUP_STATE_FLUX, org=influx_org, params={"_bucket": influx_bucket})
+    return {record.get_field(): record.get_time() for record in records}
+
+def _write_rollup_state(field: str):
+    line = f"{DENSITY_ROLLUP_STATE_MEASUREMENT} {field}=true {_to_write_ts(datetime.now(timezone.utc))}"
+    write_api_blocking.write(bucket=influx_bucket, org=influx_org, record=line, write_precision=WRITE_PRECISION)
+
+def _backfill_density_rollup():
+    """
+    Runs the rollup once over the configured history, then stores the "backfilled" marker every
+    process waits for before reading the rollup (re-running it only overwrites the same points).
+    """
+    global _density_rollup_ready, _backfill_failed
+    if not _backfill_lock.acquire(blocking=False):
+        return # Already running in this process
+    try:
+        _write_rollup_state("backfill_started")
+        query_api.query(
+            query=_DENSITY_ROLLUP_TASK.substitute(bucket=influx_bucket, lookback=settings.density_rollup_backfill),
+            org=influx_org,
+        )
+        _write_rollup_state("backfilled")
+        _density_rollup_ready = True
+        _backfill_failed = False
+        logger.info(f"Density rollup backfilled over {settings.density_rollup_backfill}; long-window density queries use it.")
+    except Exception as e:
+        _backfill_failed = True
+        logger.error(f"Density rollup backfill failed; density queries stay on raw points: {e}", exc_info=True)
+    finally:
+        _backfill_lock.release()
+
+def _dedupe_rollup_tasks(tasks_api):
+    """
+    Returns the rollup task every process agrees on (oldest, then lowest id) and deletes the others,
+    which appear when several workers start at once and each create the task.
+    """
+    tasks = tasks_api.find_tasks(name=DENSITY_ROLLUP_TASK_NAME, org=influx_org) or []
+    tasks.sort(key=lambda t: (t.created_at or datetime.max.replace(tzinfo=timezone.utc), t.id))
+    for duplicate in tasks[1:]:
         try:
-             center_lat = (min_lat + max_lat) / 2
-             center_lon = (min_lon + max_lon) / 2
-             if -90 <= center_lat <= 90 and -180 <= center_lon <= 180:
-                 center_hash = geohash.encode(center_lat, center_lon, precision=precision)
-                 logger.info(f"Using single center hash '{center_hash}' as fallback for bbox.")
-                 return [center_hash]
-        except Exception:
-             logger.error("Failed fallback to single center hash.")
-             return []
-
-    # Start the recursive check for each initial hash
-    for h in initial_hashes:
-        check_hash(h)
-
-    result = list(hashes_in_bbox)
-    logger.debug(f"Calculated {len(result)} geohash prefixes for bbox with precision {precision}")
-    return result
+            tasks_api.delete_task(duplicate.id)
+            logger.info(f"Deleted duplicate InfluxDB task '{DENSITY_ROLLUP_TASK_NAME}' ({duplicate.id}).")
+        except Exception as e: # Another worker may have deleted it first
+            logger.debug(f"Could not delete duplicate task {duplicate.id}: {e}")
+    return tasks[0] if tasks else None
+
+def ensure_density_rollup_task() -> bool:
+    """
+    Creates (or updates) the density rollup task if it is enabled, and returns True once the rollup
+    is readable, i.e. its backfill has completed (the "backfilled" marker is in the bucket).
+    Safe to run from several workers at once: duplicate tasks are deleted, and the backfill is run by
+    the worker whose task was kept (or by any worker once a started backfill is stale).
+    """
+    global _density_rollup_ready, _rollup_checked_at
+    if not settings.density_rollup_enabled or get_client() is None:
+        return False
+    with _rollup_check_lock:
+        _rollup_checked_at = time.monotonic()
+    try:
+        _validate_duration(settings.density_rollup_backfill, "density_rollup_backfill")
+        flux = _DENSITY_ROLLUP_TASK.substitute(bucket=influx_bucket, lookback="5m")
+        tasks_api = client.tasks_api()
+        created = None
+        if not tasks_api.find_tasks(name=DENSITY_ROLLUP_TASK_NAME, org=influx_org):
+            created = tasks_api.create_task(task_create_request=TaskCreateRequest(flux=flux, org=influx_org, status="active"))
+            logger.info(f"Created InfluxDB task '{DENSITY_ROLLUP_TASK_NAME}'.")
+        # Look the task up again: a worker starting at the same time may have created one as well
+        task = _dedupe_rollup_tasks(tasks_api)
+        if task is None:
+            raise RuntimeError(f"task '{DENSITY_ROLLUP_TASK_NAME}' not found after creating it")
+        if task.flux != flux:
+            task.flux = flux
+            tasks_api.update_task(task)
+            logger.info(f"Updated InfluxDB task '{DENSITY_ROLLUP_TASK_NAME}'.")
+
+        state = _rollup_state()
+        if "backfilled" in state:
+            if not _density_rollup_ready:
+                logger.info("Density rollup is backfilled; long-window density queries use it.")
+            _density_rollup_ready = True
+            return True
+
+        now = datetime.now(timezone.utc)
+        started = state.get("backfill_started") or task.created_at or now
+        if (created is not None and created.id == task.id) or _backfill_failed or started <= now - _BACKFILL_STALE_AFTER:
+            logger.info(f"Backfilling the density rollup over {settings.density_rollup_backfill} in the background.")
+            _query_pool.submit(_backfill_density_rollup)
+        else:
+            logger.info("Density rollup backfill is not complete yet; density queries stay on raw points meanwhile.")
+        return False
+    except Exception as e:
+        logger.error(f"Could not set up the density rollup task; density queries stay on raw points: {e}", exc_info=True)
+        return False
 
+def _density_rollup_available() -> bool:
+    """
+    True once the rollup is readable. Until then, re-runs ensure_density_rollup_task in the background
+    at most every _ROLLUP_RECHECK_SECONDS, which also retries a setup that failed at startup.
+    """
+    global _rollup_checked_at
+    if _density_rollup_ready:
+        return True
+    if not settings.density_rollup_enabled:
+        return False
+    now = time.monotonic()
+    with _rollup_check_lock:
+        if _rollup_checked_at is not None and now - _rollup_checked_at < _ROLLUP_RECHECK_SECONDS:
+            return False
+        _rollup_checked_at = now
+    _query_pool.submit(ensure_density_rollup_task)
+    return False
+
+def _rollup_cutoff() -> datetime:
+    """ End of the newest rollup window that is surely written (a 5-minute boundary, UTC). """
+    t = datetime.now(timezone.utc) - _ROLLUP_DELAY
+    return t - timedelta(seconds=t.timestamp() % _ROLLUP_INTERVAL.total_seconds())
 
 # --- Query Function for Pollution Density ---
 def query_density_in_bbox(
@@ -478,143 +1223,227 @@ def query_density_in_bbox(
 ) -> Optional[PollutionDensity]:
     """
     Calculates average pollution density within a bounding box and time window.
-    Uses the query_raw_points_in_bbox function to fetch data points and then
-    calculates the statistics from those points.
+    The per-pollutant sums and counts are aggregated server-side in a single reduce().
     """
-    if not query_api:
+    if get_client() is None:
         logger.error("InfluxDB query_api not available.")
         return None
 
-    # Use the existing function to get raw points in the bounding box
-    logger.info(f"Fetching raw points in bbox [{min_lat},{min_lon} - {max_lat},{max_lon}] for density calculation, window {window}")
-    raw_points = query_raw_points_in_bbox(
-        min_lat=min_lat,
-        max_lat=max_lat,
-        min_lon=min_lon,
-        max_lon=max_lon,
-        window=window,
-        limit=10000  # Use a generous limit to get a good sample for density
-    )
+    try:
+        _validate_bbox(min_lat, max_lat, min_lon, max_lon)
+        _validate_duration(window)
+    except ValueError as e:
+        logger.warning(f"Rejected density query: {e}")
+        return None
 
-    if not raw_points:
-        logger.info(f"No raw points found in bbox [{min_lat},{min_lon} - {max_lat},{max_lon}] for window {window}")
+    # ~11 m quantization: pans that land on (almost) the same view share an entry
+    cache_key = (round(min_lat, 4), round(max_lat, 4), round(min_lon, 4), round(max_lon, 4), window)
+    region_name = f"BBox:[{min_lat:.4f},{min_lon:.4f} to {max_lat:.4f},{max_lon:.4f}]" # Per request, not per cache entry
+    with _density_cache_lock:
+        cached = _density_cache.get(cache_key)
+    if cached is not None:
+        logger.debug(f"Serving density from cache for {cache_key}.")
+        averages, points = cached
+        return _density_result(region_name, averages, points)
+
+    # Sums/counts are computed inside InfluxDB; only one summary row per shard is transferred
+    shards = _density_shards(_bbox_geohash_cells(min_lat, max_lat, min_lon, max_lon))
+    flux_params = {
+        "_bucket": influx_bucket, "_window": window,
+        "_min_lat": float(min_lat), "_max_lat": float(max_lat), "_min_lon": float(min_lon), "_max_lon": float(max_lon),
+    }
+    if _duration_seconds(window) >= DENSITY_ROLLUP_MIN_WINDOW_SECONDS and _density_rollup_available():
+        # Pre-aggregated 5-minute cell rows up to the cutoff (rows are stamped with their window end,
+        # so the window ending at the cutoff is included), raw points after it
+        cutoff = _rollup_cutoff()
+        flux_queries = [_build_density_rollup_flux(prefixes) for prefixes in shards]
+        flux_params.update(_cutoff=cutoff, _rollup_stop=cutoff + timedelta(seconds=1))
+    else:
+        flux_queries = [_build_density_flux(prefixes) for prefixes in shards]
+    logger.info(f"Querying density in bbox [{min_lat},{min_lon} - {max_lat},{max_lon}], window {window} ({len(flux_queries)} shard(s))")
+    try:
+        if len(flux_queries) == 1:
+            summary = _query_density_summary(flux_queries[0], flux_params)
+        else:
+            # One failed shard fails the whole query (a partial sum would be silently wrong)
+            summary = _merge_density_summaries(
+                _density_pool.map(_query_density_summary, flux_queries, [flux_params] * len(flux_queries))
+            )
+    except InfluxDBError as e:
+        logger.error(f"InfluxDB Error querying density: {e}", exc_info=True)
+        return None
+    except Exception as e:
+        logger.error(f"Generic error querying density: {e}", exc_info=True)
         return None
 
-    # Calculate averages for each pollutant
-    pm25_values = [p.pm25 for p in raw_points if p.pm25 is not None]
-    pm10_values = [p.pm10 for p in raw_points if p.pm10 is not None]
-    no2_values = [p.no2 for p in raw_points if p.no2 is not None]
-    so2_values = [p.so2 for p in raw_points if p.so2 is not None]
-    o3_values = [p.o3 for p in raw_points if p.o3 is not None]
+    points = summary.get("points") if summary else None
+    if not points:
+        logger.info(f"No raw points found in bbox [{min_lat},{min_lon} - {max_lat},{max_lon}] for window {window}")
+        return None
 
-    # Helper function to calculate average
-    def calculate_avg(values):
-        return sum(values) / len(values) if values else None
+    # Mean per pollutant (columns follow POLLUTANT_FIELDS); None when the pollutant has no values
+    counts = [summary.get(f"{field}_count") or 0 for field in POLLUTANT_FIELDS]
+    averages = [summary[f"{field}_sum"] / count if count else None for field, count in zip(POLLUTANT_FIELDS, counts)]
 
     # Construct the result object
-    density = PollutionDensity(
-        region_name=f"BBox:[{min_lat:.4f},{min_lon:.4f} to {max_lat:.4f},{max_lon:.4f}]",
-        average_pm25=calculate_avg(pm25_values),
-        average_pm10=calculate_avg(pm10_values),
-        average_no2=calculate_avg(no2_values),
-        average_so2=calculate_avg(so2_values),
-        average_o3=calculate_avg(o3_values),
-        data_points_count=len(raw_points)
-    )
-    
+    density = _density_result(region_name, averages, points)
+
     # Log metrics about the calculation
-    logger.info(f"Calculated density for bbox from {len(raw_points)} points: "
-                f"PM2.5={density.average_pm25 or 'N/A'} (from {len(pm25_values)} values), "
-                f"PM10={density.average_pm10 or 'N/A'} (from {len(pm10_values)} values), "
-                f"NO2={density.average_no2 or 'N/A'} (from {len(no2_values)} values), "
-                f"SO2={density.average_so2 or 'N/A'} (from {len(so2_values)} values), "
-                f"O3={density.average_o3 or 'N/A'} (from {len(o3_values)} values)")
-    
+    logger.info(f"Calculated density for bbox from {points} points: "
+                f"PM2.5={density.average_pm25 or 'N/A'} (from {counts[0]} values), "
+                f"PM10={density.average_pm10 or 'N/A'} (from {counts[1]} values), "
+                f"NO2={density.average_no2 or 'N/A'} (from {counts[2]} values), "
+                f"SO2={density.average_so2 or 'N/A'} (from {counts[3]} values), "
+                f"O3={density.average_o3 or 'N/A'} (from {counts[4]} values)")
+
+    # Only the aggregates are cached: bboxes sharing a (quantized) key still get their own region_name
+    with _density_cache_lock:
+        _density_cache[cache_key] = (tuple(averages), points)
     return density
 
+def _density_result(region_name: str, averages, points: int) -> PollutionDensity:
+    """ Builds the density response from the per-pollutant averages (POLLUTANT_FIELDS order). """
+    return PollutionDensity(
+        region_name=region_name,
+        average_pm25=averages[0],
+        average_pm10=averages[1],
+        average_no2=averages[2],
+        average_so2=averages[3],
+        average_o3=averages[4],
+        data_points_count=points
+    )
+
+
+def _to_utc(ts: datetime) -> datetime:
+    """ Returns the timestamp as UTC, assuming UTC for naive datetimes. """
+    if ts.tzinfo is None:
+        return ts.replace(tzinfo=timezone.utc)
+    return ts.astimezone(timezone.utc) # Ensure it's UTC for consistency in InfluxDB
+
+def _storage_geohash(lat: Optional[float], lon: Optional[float]) -> Optional[str]:
+    """
+    Calculates the geohash tag using the `geohash_precision_storage` setting.
+    Returns None if it cannot be calculated. The tag is mandatory (every read filters on it), so
+    callers reject such a reading instead of writing it.
+    """
+    if lat is None or lon is None:
+        return None
+    try:
+        return _encode_geohash(lat, lon, settings.geohash_precision_storage)
+    except Exception as e:
+        logger.error(f"Could not calculate geohash (precision {settings.geohash_precision_storage}) for {lat},{lon}: {e}")
+        return None
+
 
 def write_air_quality_data(reading: AirQualityReading):
     """
     Writes a single AirQualityReading to InfluxDB, including a geohash tag
     calculated using the `geohash_precision_storage` setting.
+    Blocking: True means InfluxDB has accepted the point (or it was skipped for having no
+    pollutant values), so a caller can safely acknowledge the reading's source message.
     """
-    if not write_api:
+    if get_client() is None:
         logger.error("InfluxDB write_api not available.")
         return False
 
-    if reading.timestamp.tzinfo is None:
-        # logger.warning(f"Timestamp for {reading.latitude},{reading.longitude} was naive. Assuming UTC.")
-        timestamp_to_write = reading.timestamp.replace(tzinfo=timezone.utc)
-    else:
-        # Ensure it's UTC for consistency in InfluxDB
-        timestamp_to_write = reading.timestamp.astimezone(timezone.utc)
+    timestamp_to_write = _to_utc(reading.timestamp)
+    storage_precision = settings.geohash_precision_storage
+    calculated_geohash = _storage_geohash(reading.latitude, reading.longitude)
+    if calculated_geohash is None:
+        # An untagged point would never match a geohash-filtered query: reject it instead of storing it
+        logger.error(f"Rejecting write for {reading.latitude},{reading.longitude}: no geohash tag could be calculated.")
+        return False
 
-    # --- START GEOHASH CALCULATION ---
-    calculated_geohash = None
-    if reading.latitude is not None and reading.longitude is not None:
-        try:
-            # Use the precision defined in settings for storing geohashes
-            storage_precision = settings.geohash_precision_storage
-            calculated_geohash = geohash.encode(
-                reading.latitude,
-                reading.longitude,
-                precision=storage_precision # Use storage precision
-            )
-        except ImportError:
-            logger.warning("Geohash library not available for writing geohash tag. Install: pip install python-geohash")
-            calculated_geohash = None
-        except Exception as e:
-            logger.error(f"Could not calculate geohash (precision {storage_precision}) for {reading.latitude},{reading.longitude}: {e}")
-            # Proceed without the tag for robustness
-            calculated_geohash = None
-    # --- END GEOHASH CALCULATION ---
-
-    # Create the base point structure
-    # Store lat/lon also as tags for potential simple queries, but rely on geohash for spatial ones
-    point = Point("air_quality") \
-        .tag("latitude", str(reading.latitude)) \
-        .tag("longitude", str(reading.longitude)) \
-        .time(timestamp_to_write, WritePrecision.MS)
-
-    # Add the geohash tag IF it was calculated successfully
-    if calculated_geohash:
-        point.tag("geohash", calculated_geohash) # Add the geohash tag
-
-    # Add non-null fields
-    non_null_fields = {
-        k: v for k, v in reading.model_dump().items()
-        if k not in ['latitude', 'longitude', 'timestamp'] and v is not None
-    }
+    # Format the line protocol directly (geohash tag, lat/lon + non-null pollutant fields)
+    line = _to_lp(reading, calculated_geohash, _to_write_ts(timestamp_to_write))
 
-    if not non_null_fields:
+    if line is None:
         logger.warning(f"Skipping write for {reading.latitude},{reading.longitude} at {timestamp_to_write} as no pollutant fields were provided.")
         return True # Indicate skipped, not failed
 
-    for key, value in non_null_fields.items():
-        point.field(key, float(value)) # Ensure values are floats
-
-    # Write the point
     try:
-        write_api.write(bucket=influx_bucket, org=influx_org, record=point)
-        log_msg = f"Wrote point: lat={reading.latitude}, lon={reading.longitude}"
-        if calculated_geohash:
-            log_msg += f", geohash={calculated_geohash} (p{storage_precision})"
+        write_api_blocking.write(bucket=influx_bucket, org=influx_org, record=line, write_precision=WRITE_PRECISION)
         # Log full line protocol only in DEBUG level
-        logger.debug(log_msg + f" Line Protocol: {point.to_line_protocol()}")
+        logger.debug(f"Wrote point: lat={reading.latitude}, lon={reading.longitude}, geohash={calculated_geohash} (p{storage_precision}) Line Protocol: {line}")
         return True
     except InfluxDBError as e:
         logger.error(f"InfluxDB Error writing data point: {e}", exc_info=True)
         if hasattr(e, 'response'):
              logger.error(f"InfluxDB Response Headers: {e.response.headers}")
              logger.error(f"InfluxDB Response Body: {e.response.data}")
-        logger.error(f"Failed Point Line Protocol: {point.to_line_protocol()}")
+        logger.error(f"Failed Point Line Protocol: {line}")
         return False
     except Exception as e:
         logger.error(f"Generic error writing data point: {e}", exc_info=True)
-        logger.error(f"Failed Point Line Protocol: {point.to_line_protocol()}")
+        logger.error(f"Failed Point Line Protocol: {line}")
+        return False
+
+
+
+
+# --- Batched / Concurrent Writes ---
+# For backfills and multi-source fan-in: readings are formatted once, split into chunks and
+# each chunk is sent as one request. Chunks go out in parallel over the client's connection pool
+# (the blocking write_api is thread-safe), overlapping request encoding and server ingest.
+WRITE_BATCH_SIZE = 5_000
+_write_pool = ThreadPoolExecutor(max_workers=settings.influxdb_write_workers, thread_name_prefix="influx-write")
+atexit.register(_write_pool.shutdown)
+
+def _write_lp_chunk(lines: List[str]) -> bool:
+    """ Writes one chunk of line protocol strings in a single request. """
+    try:
+        # Hand the client a ready bytes body: it is sent as-is, with no per-record serialize/encode step
+        payload = "\n".join(lines).encode("utf-8")
+        write_api_blocking.write(bucket=influx_bucket, org=influx_org, record=payload, write_precision=WRITE_PRECISION)
+        return True
+    except InfluxDBError as e:
+        logger.error(f"InfluxDB Error writing batch of {len(lines)} points: {e}", exc_info=True)
+        return False
+    except Exception as e:
+        logger.error(f"Generic error writing batch of {len(lines)} points: {e}", exc_info=True)
         return False
 
+def write_air_quality_batch(readings: List[AirQualityReading], batch_size: int = WRITE_BATCH_SIZE) -> int:
+    """
+    Writes many AirQualityReadings to InfluxDB in chunks of `batch_size` points,
+    sending the chunks concurrently. Readings without pollutant values or without a geohash tag are skipped.
+    Returns the number of points written successfully.
+    """
+    if get_client() is None:
+        logger.error("InfluxDB write_api not available.")
+        return 0
 
+    # Geohash tags for the whole batch in one vectorized pass instead of one encode call per reading
+    geohashes = []
+    if readings:
+        try:
+            geohashes = encode_geohashes(
+                np.fromiter((r.latitude for r in readings), dtype=np.float64, count=len(readings)),
+                np.fromiter((r.longitude for r in readings), dtype=np.float64, count=len(readings)),
+                settings.geohash_precision_storage,
+            )
+        except Exception as e:
+            logger.error(f"Bulk geohash encoding failed, encoding per reading: {e}", exc_info=True)
+            geohashes = [_storage_geohash(r.latitude, r.longitude) for r in readings]
+
+    lines = []
+    untagged = 0
+    for reading, gh in zip(readings, geohashes):
+        if gh is None:
+            untagged += 1
+            continue
+        line = _to_lp(reading, gh, _to_write_ts(_to_utc(reading.timestamp)))
+        if line is not None:
+            lines.append(line)
+    if untagged:
+        logger.error(f"Rejected {untagged} reading(s) without a geohash tag.")
+    if not lines:
+        return 0
+
+    chunks = [lines[i:i + batch_size] for i in range(0, len(lines), batch_size)]
+    written = sum(len(chunk) for chunk, ok in zip(chunks, _write_pool.map(_write_lp_chunk, chunks)) if ok)
+    logger.info(f"Wrote {written}/{len(lines)} points in {len(chunks)} batch(es).")
+    return written
 
 
 # --- Query Function for Time Series History ---
@@ -628,63 +1457,50 @@ def query_location_history(
     Queries historical time series data for a specific parameter within a geohash cell.
     Aggregates data into time windows (e.g., 10-minute averages).
     """
-    if not query_api:
+    if get_client() is None:
         logger.error("InfluxDB query_api not available for history query.")
         return []
-    if not geohash:
-        logger.error("Geohash library not available. Cannot perform geohash-based query.")
-        return []
 
     # Validate parameter
     valid_parameters = {'pm25', 'pm10', 'no2', 'so2', 'o3', 'co'} # Add 'co' if needed
     if parameter not in valid_parameters:
         logger.error(f"Invalid parameter requested for history: {parameter}")
         return []
+    try:
+        if not _GEOHASH_RE.match(geohash_str):
+            raise ValueError(f"Invalid geohash: {geohash_str!r}")
+        _validate_duration(window)
+        _validate_duration(aggregate_window, "aggregate_window")
+    except ValueError as e:
+        logger.error(f"Rejected history query: {e}")
+        return []
 
     logger.info(f"Querying history for geohash '{geohash_str}', parameter '{parameter}', window '{window}', aggregate '{aggregate_window}'")
 
     # Construct Flux query
-    flux_query = f'''
-        import "math"
-        import "types"
-
-        from(bucket: "{influx_bucket}")
-          |> range(start: -{window})
-          |> filter(fn: (r) => r["_measurement"] == "air_quality")
-          |> filter(fn: (r) => r["geohash"] == "{geohash_str}") // Filter by the specific geohash tag
-          |> filter(fn: (r) => r["_field"] == "{parameter}") // Filter by the specific parameter field
-          // Ensure values are valid numbers
-          |> filter(fn: (r) => types.isNumeric(v: r._value) and not math.isNaN(f: r._value))
-          // Aggregate into time windows (e.g., calculate the mean every 10 minutes)
-          |> aggregateWindow(every: {aggregate_window}, fn: mean, createEmpty: false)
-          |> yield(name: "mean_values")
-    '''
-    logger.info(f"Executing Flux query for location history:\\n{flux_query}")
+    flux_query = _LOCATION_HISTORY_FLUX
+    flux_params = {
+        "_bucket": influx_bucket, "_window": window, "_geohash": geohash_str,
+        "_parameter": parameter, "_every": aggregate_window
+    }
+    logger.info(f"Executing Flux query for location history with params {flux_params}:\n{flux_query}")
 
     results: List[TimeSeriesDataPoint] = []
     try:
-        tables = query_api.query(query=flux_query, org=influx_org)
+        # Stream records straight off the response instead of materializing FluxTable objects first
+        records = query_api.query_stream(query=flux_query, org=influx_org, params=flux_params)
 
-        if not tables:
+        # One pass over the (already sorted) windows; aggregateWindow output is numeric, so no per-record parsing guard
+        results = [
+            TimeSeriesDataPoint(timestamp=values["_time"], value=float(values["_value"]))
+            for values in (record.values for record in records)
+            if values.get("_time") is not None and values.get("_value") is not None
+        ]
+
+        if not results:
             logger.info(f"No history data found for geohash {geohash_str}, param {parameter}, window {window}.")
             return []
 
-        for table in tables:
-            for record in table.records:
-                try:
-                    timestamp = record.get_time()
-                    value = record.get_value()
-
-                    if timestamp is not None and value is not None:
-                        results.append(TimeSeriesDataPoint(timestamp=timestamp, value=float(value)))
-                except (ValueError, TypeError, KeyError) as e:
-                    logger.error(f"Error processing history record: {e} - Record: {record.values}", exc_info=False)
-                except Exception as e:
-                    logger.error(f"Unexpected error processing history record: {e} - Record: {record.values}", exc_info=True)
-
-        # Sort results by timestamp ascending (aggregateWindow might not guarantee order)
-        results.sort(key=lambda dp: dp.timestamp)
-
         logger.info(f"Retrieved {len(results)} history data points for geohash {geohash_str}, param {parameter}.")
         return results
 
@@ -701,6 +1517,112 @@ def query_location_history(
 
 
 # --- Example Query Function ---
+# Geohash precision used to cover the 50 km radius estimate area (cells ~39 x 20 km)
+RADIUS_GEOHASH_PRECISION = 4
+# Upper bound on the cell summaries averaged into the radius estimate (the nearest ones are kept). Only
+# reached when the storage geohash precision is fine enough to yield a huge number of cells in range.
+RADIUS_MAX_CELLS = 2000
+# Runs the radius estimate alongside the exact-cell lookup so a cold tile costs max(t1, t2), not t1 + t2
+_query_pool = ThreadPoolExecutor(max_workers=settings.influxdb_query_workers, thread_name_prefix="influx-query")
+atexit.register(_query_pool.shutdown, cancel_futures=True)
+
+def _estimate_within_radius(lat: float, lon: float, window: str) -> Optional[AirQualityReading]:
+    """
+    Estimates the air quality at (lat, lon) by averaging all points stored within 50 km
+    during the time window. Returns None if there are none or the query fails.
+    """
+    flux_params = {"_bucket": influx_bucket, "_window": window}
+    try:
+        # Approximate 50 km in degrees (1 deg lat ~ 111 km)
+        delta_deg = 50.0 / 111.0
+        min_lat = max(lat - delta_deg, -90.0)
+        max_lat = min(lat + delta_deg, 90.0)
+        min_lon = max(lon - delta_deg, -180.0)
+        max_lon = min(lon + delta_deg, 180.0)
+
+        # Geohash cells covering the bounding box; matching on the tag prefix lets storage pick the
+        # series by index instead of pivoting and scanning every point's lat/lon
+        prefixes = calculate_geohashes_for_bbox(min_lat, max_lat, min_lon, max_lon, RADIUS_GEOHASH_PRECISION)
+        if not prefixes:
+            logger.error(f"Could not calculate geohash cells for 50 km radius around ({lat},{lon}).")
+            return None
+
+        # Query the per-cell summaries for those cells in the time window
+        # (the prefix list is generated here, not user input, and must stay a regex literal for the storage pushdown)
+        flux_query_radius = _build_radius_flux(tuple(prefixes))
+        logger.debug(f"Executing Flux query for 50km radius estimate:\n{flux_query_radius}")
+
+        # Fold the per-cell summaries into flat rows as they stream in, one pass, no per-field dicts:
+        # geohash -> (sums, counts, [latest]) with sums/counts indexed like _READING_KEYS
+        cells = {}
+        n_keys = len(_READING_KEYS)
+        records = query_api.query_stream(query=flux_query_radius, org=influx_org, params=flux_params)
+        for record in records:
+            data = record.values
+            i = _READING_KEY_INDEX.get(data.get("_field"))
+            if i is None:
+                continue
+            cell = cells.get(data.get("geohash"))
+            if cell is None:
+                cell = cells[data.get("geohash")] = ([0.0] * n_keys, [0] * n_keys, [None])
+            cell[0][i] = data.get("sum")
+            cell[1][i] = data.get("count")
+            latest = data.get("latest")
+            if latest and (cell[2][0] is None or latest > cell[2][0]):
+                cell[2][0] = latest
+
+        cells = list(cells.values())
+        within = np.empty(0, dtype=np.intp)
+        if cells:
+            sums = np.array([c[0] for c in cells], dtype=np.float64) # (cells, keys)
+            counts = np.array([c[1] for c in cells], dtype=np.int64)
+            # Only cells that report a position can be placed on the map (0/0 -> NaN drops out below)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                positions = sums[:, :2] / counts[:, :2]
+
+            # Haversine distance from the center (lat, lon) to each cell's mean position (Numba kernel when available)
+            within = np.flatnonzero(within_radius(positions[:, 0], positions[:, 1], lat, lon, 50.0))
+            if len(within) > RADIUS_MAX_CELLS:
+                # Keep the nearest cells: order by (equirectangular) distance, which is exact enough at 50 km
+                dlat = positions[within, 0] - lat
+                dlon = (positions[within, 1] - lon) * cos(radians(lat))
+                within = within[np.argsort(dlat ** 2 + dlon ** 2, kind="stable")[:RADIUS_MAX_CELLS]]
+                logger.warning(f"50 km radius estimate around ({lat},{lon}) capped at the {RADIUS_MAX_CELLS} nearest geohash cells.")
+
+        if len(within) == 0:
+            logger.info(f"No data found within 50 km radius of ({lat},{lon}) in the last {window}.")
+            return None
+
+        # Average the values for estimate: total sum / total count per pollutant over the cells in range,
+        # which equals the mean over all of their points
+        pollutant_sums = sums[within, 2:].sum(axis=0)
+        pollutant_counts = counts[within, 2:].sum(axis=0)
+        averages = [float(s) / int(c) if c else None for s, c in zip(pollutant_sums, pollutant_counts)]
+        point_count = int(counts[within, 0].sum())
+
+        # Use the most recent timestamp among the points
+        latest_ts = max((cells[i][2][0] for i in within if cells[i][2][0]), default=None)
+
+        estimate = AirQualityReading(
+            latitude=lat,
+            longitude=lon,
+            timestamp=latest_ts,
+            pm25=averages[0],
+            pm10=averages[1],
+            no2=averages[2],
+            so2=averages[3],
+            o3=averages[4]
+        )
+        logger.info(f"Estimated air quality at ({lat},{lon}) using {point_count} points in {len(within)} geohash cells within 50 km radius.")
+        return estimate
+
+    except InfluxDBError as e:
+        logger.error(f"InfluxDB Error estimating 50 km radius data around ({lat},{lon}): {e}", exc_info=True)
+        return None
+    except Exception as e:
+        logger.error(f"Generic error estimating 50 km radius data around ({lat},{lon}): {e}", exc_info=True)
+        return None
+
 def query_latest_location_data(
     lat: float,
     lon: float,
@@ -708,164 +1630,140 @@ def query_latest_location_data(
     window: str = "1h"  # Time window to look back
 ) -> Optional[AirQualityReading]:
     """
-    Queries the latest data point within a specific geohash cell, determined
-    by the given lat/lon and precision. If no data is found, estimate by
+    Queries the latest data point near the geohash cell determined by the given
+    lat/lon and precision (the nearest cell sharing a slightly shorter prefix
+    with it). If no data is found, estimate by
     expanding the search to a 50 km radius and averaging available points.
+    The radius estimate is started concurrently and discarded if the cell has data.
     """
-    if not query_api:
+    if get_client() is None:
         logger.error("InfluxDB query_api not available.")
         return None
-    if not geohash:
-        logger.error("Geohash library not available. Cannot perform geohash-based query.")
+    try:
+        _validate_coordinates(lat, lon)
+        _validate_duration(window)
+    except ValueError as e:
+        logger.warning(f"Rejected latest location query: {e}")
         return None
 
     try:
         # Calculate the target geohash for the given coordinates and precision
-        target_geohash = geohash.encode(lat, lon, precision=precision)
+        target_geohash = _encode_geohash(lat, lon, precision)
         logger.info(f"Querying latest data for geohash '{target_geohash}' (precision {precision}) near ({lat},{lon}), window '{window}'")
     except Exception as e:
         logger.error(f"Failed to calculate geohash for ({lat},{lon}) with precision {precision}: {e}", exc_info=True)
         return None
 
-    # Construct Flux query filtering by the calculated geohash tag
-    flux_query = f'''
-        from(bucket: "{influx_bucket}")
-          |> range(start: -{window})
-          |> filter(fn: (r) => r["_measurement"] == "air_quality")
-          |> filter(fn: (r) => r["geohash"] == "{target_geohash}") // Filter by the specific geohash tag
-          |> last() // Get the most recent point for each field within this geohash cell
-          |> pivot(rowKey:["_time", "geohash", "latitude", "longitude"], columnKey: ["_field"], valueColumn: "_value") // Reshape fields into columns, keep original tags
-    '''
-    logger.debug(f"Executing Flux query for specific geohash cell:\n{flux_query}")
+    # Start the fallback right away; it is cancelled (or its result ignored) if the cell has data
+    radius_future = _query_pool.submit(_estimate_within_radius, lat, lon, window)
 
-    try:
-        tables = query_api.query(query=flux_query, org=influx_org)
+    # Probe a slightly coarser prefix instead of the exact cell: high-precision cells (7-8 chars, or anything
+    # finer than the stored geohash tags) almost never match exactly, which would force the radius fallback.
+    # The prefix covers the target cell and its neighborhood; the nearest cell found is used.
+    probe_prefix = target_geohash[:max(4, precision - 2)]
+    flux_query = _build_latest_cell_flux(probe_prefix)
+    flux_params = {"_bucket": influx_bucket, "_window": window}
+    logger.debug(f"Executing Flux query for geohash prefix '{probe_prefix}':\n{flux_query}")
 
-        if tables and tables[0].records:
-            # Process the result (pivot makes this easier)
-            record = tables[0].records[0]  # Get the first (and only) record after pivot
-            data = record.values  # Dictionary of fields and tags included in pivot rowKey
+    try:
+        records = query_api.query_stream(query=flux_query, org=influx_org, params=flux_params)
+
+        # last() leaves one row per field and series; collect them keyed by geohash and _field instead of pivoting
+        # server-side. If a cell holds several series, the newest value of each field wins.
+        cells = {} # geohash -> (field values, field times)
+        for record in records: # Streamed: no FluxTable list is built up front
+            field, record_time = record.get_field(), record.get_time()
+            data, field_times = cells.setdefault(record.values.get("geohash"), ({}, {}))
+            if field not in field_times or record_time > field_times[field]:
+                field_times[field] = record_time
+                data[field] = record.get_value()
+
+        if cells:
+            # Nearest cell to (lat, lon); a planar distance is plenty for ranking cells this close together
+            cos_center = cos(radians(lat))
+            def planar_sq_distance(cell):
+                cell_data = cell[0]
+                if cell_data.get('latitude') is None or cell_data.get('longitude') is None:
+                    return float("inf") # Legacy series without position fields: only used if nothing else matched
+                return (cell_data['latitude'] - lat) ** 2 + ((cell_data['longitude'] - lon) * cos_center) ** 2
+            data, field_times = min(cells.values(), key=planar_sq_distance)
 
             # Convert the dictionary result back to Pydantic model
             try:
                 stored_lat = float(data.get('latitude', lat))
                 stored_lon = float(data.get('longitude', lon))
 
-                reading = AirQualityReading(
+                # Stored values were validated at ingest and FluxRecord times are UTC: skip re-validation
+                reading = AirQualityReading.model_construct(
                     latitude=stored_lat,
                     longitude=stored_lon,
-                    timestamp=record.get_time(),
+                    timestamp=max(field_times.values()), # Most recent update in the cell
                     pm25=data.get('pm25'),
                     pm10=data.get('pm10'),
                     no2=data.get('no2'),
                     so2=data.get('so2'),
                     o3=data.get('o3')
                 )
-                logger.debug(f"Query result for geohash {target_geohash}: {reading}")
+                logger.debug(f"Query result for geohash prefix {probe_prefix} (nearest of {len(cells)} cells): {reading}")
+                radius_future.cancel() # Cell hit: the estimate is not needed
                 return reading
             except (ValueError, TypeError, KeyError) as e:
                 logger.error(f"Error converting query result for geohash {target_geohash} to Pydantic model: {e}. Data: {data}", exc_info=False)
+                radius_future.cancel()
                 return None
 
-        # --- No data found: Estimate using 50 km radius ---
-        logger.info(f"No data found for geohash '{target_geohash}' (precision {precision}) near {lat},{lon} in the last {window}. Estimating using 50 km radius.")
-
-        # Approximate 50 km in degrees (1 deg lat ~ 111 km)
-        delta_deg = 50.0 / 111.0
-        min_lat = lat - delta_deg
-        max_lat = lat + delta_deg
-        min_lon = lon - delta_deg
-        max_lon = lon + delta_deg
-
-        # Query all points in the bounding box in the time window
-        flux_query_radius = f'''
-            from(bucket: "{influx_bucket}")
-              |> range(start: -{window})
-              |> filter(fn: (r) => r["_measurement"] == "air_quality")
-              |> filter(fn: (r) => exists r.latitude and exists r.longitude)
-              |> map(fn: (r) => ({{ r with latitude_float: float(v: r.latitude), longitude_float: float(v: r.longitude) }}))
-              |> filter(fn: (r) => r.latitude_float >= {min_lat} and r.latitude_float <= {max_lat} and r.longitude_float >= {min_lon} and r.longitude_float <= {max_lon})
-              |> sort(columns: ["_time"], desc: true)
-              |> pivot(rowKey:["_time", "latitude", "longitude"], columnKey: ["_field"], valueColumn: "_value")
-        '''
-        logger.debug(f"Executing Flux query for 50km radius estimate:\n{flux_query_radius}")
-
-        tables_radius = query_api.query(query=flux_query_radius, org=influx_org)
-        points = []
-        for table in tables_radius:
-            for record in table.records:
-                data = record.values
-                try:
-                    stored_lat = float(data.get('latitude', lat))
-                    stored_lon = float(data.get('longitude', lon))
-                    # Calculate distance to center (lat, lon)
-                    R = 6371.0  # Earth radius in km
-                    dlat = radians(stored_lat - lat)
-                    dlon = radians(stored_lon - lon)
-                    a = sin(dlat / 2) ** 2 + cos(radians(lat)) * cos(radians(stored_lat)) * sin(dlon / 2) ** 2
-                    c = 2 * atan2(sqrt(a), sqrt(1 - a))
-                    distance = R * c
-                    if distance <= 50.0:
-                        points.append({
-                            "latitude": stored_lat,
-                            "longitude": stored_lon,
-                            "timestamp": record.get_time(),
-                            "pm25": data.get('pm25'),
-                            "pm10": data.get('pm10'),
-                            "no2": data.get('no2'),
-                            "so2": data.get('so2'),
-                            "o3": data.get('o3')
-                        })
-                except Exception as e:
-                    logger.debug(f"Skipping record in radius estimate: {e}")
-
-        if not points:
-            logger.info(f"No data found within 50 km radius of ({lat},{lon}) in the last {window}.")
-            return None
-
-        # Average the values for estimate
-        def safe_float(val):
-            try:
-                return float(val)
-            except Exception:
-                return None
-
-        def avg(values):
-            vals = [safe_float(v) for v in values if v is not None]
-            return sum(vals) / len(vals) if vals else None
-
-        pm25_avg = avg([p["pm25"] for p in points])
-        pm10_avg = avg([p["pm10"] for p in points])
-        no2_avg = avg([p["no2"] for p in points])
-        so2_avg = avg([p["so2"] for p in points])
-        o3_avg = avg([p["o3"] for p in points])
-
-        # Use the most recent timestamp among the points
-        latest_ts = max((p["timestamp"] for p in points if p["timestamp"]), default=None)
-
-        estimate = AirQualityReading(
-            latitude=lat,
-            longitude=lon,
-            timestamp=latest_ts,
-            pm25=pm25_avg,
-            pm10=pm10_avg,
-            no2=no2_avg,
-            so2=so2_avg,
-            o3=o3_avg
-        )
-        logger.info(f"Estimated air quality at ({lat},{lon}) using {len(points)} points within 50 km radius.")
-        return estimate
-
     except InfluxDBError as e:
         logger.error(f"InfluxDB Error querying specific geohash cell data ({target_geohash}): {e}", exc_info=True)
+        radius_future.cancel()
         return None
     except Exception as e:
         logger.error(f"Generic error querying specific geohash cell data ({target_geohash}): {e}", exc_info=True)
+        radius_future.cancel()
         return None
+
+    # --- No data found: use the 50 km radius estimate ---
+    logger.info(f"No data found for geohash prefix '{probe_prefix}' (target '{target_geohash}', precision {precision}) near {lat},{lon} in the last {window}. Estimating using 50 km radius.")
+    return radius_future.result()
+
+# --- Cache Statistics ---
+def get_cache_stats() -> dict:
+    """ Hit/miss/size counters of the in-process caches, for the debug endpoint. """
+    def lru(fn):
+        info = fn.cache_info()
+        return {"hits": info.hits, "misses": info.misses, "size": info.currsize, "maxsize": info.maxsize}
+    def ttl(cache, lock):
+        with lock:
+            return {"size": cache.currsize, "maxsize": cache.maxsize, "ttl_seconds": cache.ttl}
+    return {
+        "bbox_geohashes": lru(_grid_geohashes),
+        "geohash_encode": lru(_encode_geohash_cached),
+        "radius_flux": lru(_build_radius_flux),
+        "latest_cell_flux": lru(_build_latest_cell_flux),
+        "raw_bbox_flux": lru(_build_raw_bbox_flux),
+        "density_flux": lru(_build_density_flux),
+        "density_rollup_flux": lru(_build_density_rollup_flux),
+        "density_results": ttl(_density_cache, _density_cache_lock),
+        "recent_points_results": ttl(_recent_points_cache, _recent_points_cache_lock),
+        "anomaly_results": ttl(_anomaly_cache, _anomaly_cache_lock),
+    }
+
 def close_influx_client():
-    if client:
+    global client, write_api_blocking, query_api
+    with _client_lock:
+        if not client:
+            return
         logger.info("Closing InfluxDB client.")
         try:
+            # Let in-flight chunk writes finish and drop queued background queries before the
+            # connection pool they use is closed
+            _write_pool.shutdown(wait=True)
+            _query_pool.shutdown(wait=True, cancel_futures=True)
+            _density_pool.shutdown(wait=True, cancel_futures=True)
+            if write_api_blocking:
+                write_api_blocking.close()
             client.close()
         except Exception as e:
-            logger.error(f"Error closing InfluxDB client: {e}", exc_info=True)
\ No newline at end of file
+            logger.error(f"Error closing InfluxDB client: {e}", exc_info=True)
+        finally:
+            # Never hand out the closed objects: get_client() sees None and does not return a dead client
+            client = write_api_blocking = query_api = None
\ No newline at end of file
@@ -0,0 +1,172 @@
+# backend/app/geo.py
+# Distance math for the 50 km radius estimate and geohash grid enumeration. Uses Numba-compiled
+# kernels when numba is installed, otherwise equivalent vectorized NumPy versions.
+import logging
+import math
+import numpy as np
+from typing import List
+
+try:
+    from numba import njit # Optional: pip install numba
+except ImportError:
+    njit = None
+
+logger = logging.getLogger(__name__)
+
+EARTH_RADIUS_KM = 6371.0
+PRETEST_MARGIN_KM = 5.0 # Slack for the cheap planar pre-test before the exact haversine
+
+if njit is not None:
+    # fastmath without 'nnan'/'ninf': NaN positions (cells without lat/lon) must still compare False
+    @njit(fastmath={"nsz", "arcp", "contract", "afn", "reassoc"}, cache=True)
+    def _within_radius_jit(lats, lons, center_lat, center_lon, radius_km):
+        n = lats.shape[0]
+        mask = np.zeros(n, np.bool_)
+        center_lat_rad = math.radians(center_lat)
+        center_lon_rad = math.radians(center_lon)
+        cos_center = math.cos(center_lat_rad)
+        pretest_km = radius_km + PRETEST_MARGIN_KM
+        for i in range(n):
+            lat_rad = math.radians(lats[i])
+            dlat = lat_rad - center_lat_rad
+            dlon = math.radians(lons[i]) - center_lon_rad
+            # Planar (equirectangular) pre-test: skips the trig below for points clearly outside
+            if not EARTH_RADIUS_KM * math.sqrt((dlon * cos_center) ** 2 + dlat ** 2) <= pretest_km:
+                continue
+            a = math.sin(dlat / 2) ** 2 + cos_center * math.cos(lat_rad) * math.sin(dlon / 2) ** 2
+            mask[i] = 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(min(a, 1.0))) <= radius_km
+        return mask
+else:
+    _within_radius_jit = None
+    logger.info("numba not installed; radius distance checks and geohash grids use the NumPy implementation.")
+
+def _within_radius_numpy(lats: np.ndarray, lons: np.ndarray, center_lat: float, center_lon: float, radius_km: float) -> np.ndarray:
+    # Center terms are constant: convert/evaluate them once
+    center_lat_rad = math.radians(center_lat)
+    center_lon_rad = math.radians(center_lon)
+    cos_center = math.cos(center_lat_rad)
+    # Convert the positions to radians once; reused for the deltas and the cosine term
+    lats_rad = np.radians(lats)
+    dlat = lats_rad - center_lat_rad
+    dlon = np.radians(lons) - center_lon_rad
+    # Cheap planar (equirectangular) pre-test with a margin, so only the remaining candidates
+    # need the trig-heavy haversine
+    approx_km = EARTH_RADIUS_KM * np.sqrt((dlon * cos_center) ** 2 + dlat ** 2)
+    candidates = np.flatnonzero(approx_km <= radius_km + PRETEST_MARGIN_KM) # NaN positions compare False and drop out
+    dlat, dlon = dlat[candidates], dlon[candidates]
+    a = np.sin(dlat / 2) ** 2 + cos_center * np.cos(lats_rad[candidates]) * np.sin(dlon / 2) ** 2
+    distances = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0))) # Clamp: FP drift can push a just above 1
+    mask = np.zeros(len(lats), dtype=bool)
+    mask[candidates[distances <= radius_km]] = True
+    return mask
+
+def within_radius(lats, lons, center_lat: float, center_lon: float, radius_km: float) -> np.ndarray:
+    """
+    Returns a boolean mask of the positions within `radius_km` (haversine distance) of the center.
+    NaN positions are never inside.
+    """
+    lats = np.ascontiguousarray(lats, dtype=np.float64)
+    lons = np.ascontiguousarray(lons, dtype=np.float64)
+    if _within_radius_jit is not None:
+        return _within_radius_jit(lats, lons, float(center_lat), float(center_lon), float(radius_km))
+    return _within_radius_numpy(lats, lons, center_lat, center_lon, radius_km)
+
+# --- Geohash bit math ---
+# A geohash is the interleaved bits of the cell's column (longitude) and row (latitude) index,
+# longitude first, written 5 bits per base32 character. Cells can therefore be encoded with
+# integer shifts instead of the float bisection geohash.encode runs per call.
+_BASE32 = np.frombuffer(b"0123456789bcdefghjkmnpqrstuvwxyz", dtype=np.uint8)
+
+def _bit_split(precision: int):
+    """ (lat_bits, lon_bits) for a precision; longitude gets the extra bit on odd totals. """
+    total_bits = 5 * precision
+    return total_bits // 2, total_bits - total_bits // 2
+
+if njit is not None:
+    @njit(cache=True)
+    def _interleave_jit(rows, cols, lat_bits, lon_bits):
+        n = rows.shape[0]
+        codes = np.empty(n, np.int64)
+        total_bits = lat_bits + lon_bits
+        for k in range(n):
+            row = rows[k]
+            col = cols[k]
+            code = 0
+            for bit in range(total_bits): # Most significant first: lon, lat, lon, ...
+                if bit % 2 == 0:
+                    code = (code << 1) | ((col >> (lon_bits - 1 - bit // 2)) & 1)
+                else:
+                    code = (code << 1) | ((row >> (lat_bits - 1 - bit // 2)) & 1)
+            codes[k] = code
+        return codes
+else:
+    _interleave_jit = None
+
+def _interleave_numpy(rows: np.ndarray, cols: np.ndarray, lat_bits: int, lon_bits: int) -> np.ndarray:
+    codes = np.zeros(len(rows), dtype=np.int64)
+    for bit in range(lat_bits + lon_bits): # One vectorized shift/or per bit instead of per cell
+        if bit % 2 == 0:
+            codes = (codes << 1) | ((cols >> (lon_bits - 1 - bit // 2)) & 1)
+        else:
+            codes = (codes << 1) | ((rows >> (lat_bits - 1 - bit // 2)) & 1)
+    return codes
+
+def _geohashes_from_indices(rows: np.ndarray, cols: np.ndarray, precision: int) -> List[str]:
+    lat_bits, lon_bits = _bit_split(precision)
+    rows = np.ascontiguousarray(rows, dtype=np.int64)
+    cols = np.ascontiguousarray(cols, dtype=np.int64)
+    if _interleave_jit is not None:
+        codes = _interleave_jit(rows, cols, lat_bits, lon_bits)
+    else:
+        codes = _interleave_numpy(rows, cols, lat_bits, lon_bits)
+    # Base32 only at the boundary: 5-bit groups -> characters, then one fixed-width bytes view per cell
+    shifts = np.arange(precision - 1, -1, -1, dtype=np.int64) * 5
+    chars = _BASE32[(codes[:, None] >> shifts) & 31]
+    return np.ascontiguousarray(chars).view(f"S{precision}").ravel().astype(f"U{precision}").tolist()
+
+def grid_geohashes(row_start: int, row_end: int, col_start: int, col_end: int, precision: int) -> List[str]:
+    """
+    Geohashes of the given precision for the block of grid cells rows [row_start, row_end] x
+    columns [col_start, col_end] (row 0 at -90 lat, column 0 at -180 lon), in row-major order.
+    """
+    rows, cols = np.meshgrid(
+        np.arange(row_start, row_end + 1, dtype=np.int64),
+        np.arange(col_start, col_end + 1, dtype=np.int64),
+        indexing="ij",
+    )
+    return _geohashes_from_indices(rows.ravel(), cols.ravel(), precision)
+
+GEOHASH_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz" # Geohash alphabet (no a, i, l, o)
+
+def encode_geohash(lat: float, lon: float, precision: int) -> str:
+    """
+    Geohash of one position with plain integer math (same result as encode_geohashes and, inside
+    the valid range, geohash.encode), so the app does not need the python-geohash C extension.
+    lat == 90 is encoded in the last row and lon == 180 wraps to -180.
+    """
+    lat_bits, lon_bits = _bit_split(precision)
+    row = min(max(int((lat + 90.0) / 180.0 * (1 << lat_bits)), 0), (1 << lat_bits) - 1)
+    col = int((lon + 180.0) / 360.0 * (1 << lon_bits)) % (1 << lon_bits) # lon == 180 wraps to -180
+    code = 0
+    for bit in range(lat_bits + lon_bits): # Most significant first: lon, lat, lon, ...
+        if bit % 2 == 0:
+            code = (code << 1) | ((col >> (lon_bits - 1 - bit // 2)) & 1)
+        else:
+            code = (code << 1) | ((row >> (lat_bits - 1 - bit // 2)) & 1)
+    return "".join(GEOHASH_BASE32[(code >> shift) & 31] for shift in range(5 * (precision - 1), -1, -5))
+
+def encode_geohashes(lats, lons, precision: int) -> List[str]:
+    """
+    Geohash of each (lat, lon) pair, same result as geohash.encode per point, computed in one
+    vectorized pass (bulk writes). Positions must be finite and in range.
+    """
+    lat_bits, lon_bits = _bit_split(precision)
+    # Quantize the exact positions to the cell row/column (no rounding: must match a per-point encode)
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    rows = np.floor((lats + 90.0) / 180.0 * (1 << lat_bits)).astype(np.int64)
+    cols = np.floor((lons + 180.0) / 360.0 * (1 << lon_bits)).astype(np.int64)
+    # Same edges as encode_geohash: lat == 90 stays in the last row, lon == 180 wraps around to -180
+    np.clip(rows, 0, (1 << lat_bits) - 1, out=rows)
+    cols %= 1 << lon_bits
+    return _geohashes_from_indices(rows, cols, precision)
@@ -2,7 +2,7 @@
 from fastapi.middleware.cors import CORSMiddleware
 from collections import defaultdict
 import random
-import geohash
+import uuid
 from typing import List, Optional
 from datetime import datetime, timezone, timedelta
 from contextlib import asynccontextmanager
@@ -11,10 +11,13 @@ import asyncio
 import aio_pika
 import json
 from fastapi import FastAPI, Query, HTTPException, Body, status, WebSocket, WebSocketDisconnect, Path
+from fastapi.responses import ORJSONResponse # orjson's C encoder for all JSON responses
+from fastapi.concurrency import run_in_threadpool # InfluxDB calls are blocking: keep them off the event loop
 from .models import IngestRequest, AirQualityReading, Anomaly, PollutionDensity, AggregatedAirQualityPoint, TimeSeriesDataPoint
 from .db_client import (
     query_latest_location_data,
     query_raw_points_in_bbox,
+    query_recent_points_columnar,
     query_anomalies_from_db,
     query_density_in_bbox,
     query_location_history,
@@ -25,6 +28,7 @@ from . import db_client # Keep for close_influx_client call
 from . import queue_client # Import queue_client for publishing and consuming
 from . import websocket_manager # Import WebSocket manager (used locally now)
 from .aggregation import aggregate_by_geohash # Import aggregation function
+from .geo import encode_geohash, GEOHASH_BASE32
 from .config import get_settings # Import get_settings
 
 settings = get_settings() # Get settings instance
@@ -82,6 +86,8 @@ async def consume_broadcasts():
                         if isinstance(anomaly_data, dict) and 'id' in anomaly_data and 'parameter' in anomaly_data:
                             # Re-create Anomaly object (optional, could just pass dict)
                             anomaly = Anomaly(**anomaly_data)
+                            # The worker wrote a new anomaly; cached /anomalies results are now stale
+                            db_client.invalidate_anomaly_cache()
                             logger.info(f"BROADCAST_CONSUMER: Broadcasting anomaly {anomaly.id} received from queue.")
                             # Use the LOCAL websocket manager instance to broadcast
                             await websocket_manager.manager.broadcast_anomaly(anomaly)
@@ -137,6 +143,9 @@ async def lifespan(app: FastAPI):
     # Initialize RabbitMQ connection pool (for publishing)
     await queue_client.initialize_rabbitmq_pool()
 
+    # Density rollup task (creates it and backfills in the background on first start)
+    await run_in_threadpool(db_client.ensure_density_rollup_task)
+
     # Start the RabbitMQ broadcast consumer in the background
     logger.info("API Startup: Starting RabbitMQ broadcast consumer task...")
     loop = asyncio.get_running_loop()
@@ -167,7 +176,8 @@ app = FastAPI(
     title="Air Quality API",
     description="API for collecting, analyzing, and visualizing air quality data.",
     version="0.1.0",
-    lifespan=lifespan # Add lifespan manager
+    lifespan=lifespan, # Add lifespan manager
+    default_response_class=ORJSONResponse # Serialize readings/anomalies with orjson instead of stdlib json
 )
 
 
@@ -221,10 +231,11 @@ async def get_heatmap_data(
     max_lon: float = Query(..., description="Maximum longitude of the bounding box.", ge=-180, le=180),
     zoom: Optional[int] = Query(None, description="Current map zoom level, used to determine aggregation precision."),
     window: str = Query("1h", description="Time window to fetch data from (e.g., '1h', '24h', '15m'). Format: InfluxDB duration literal."),
+    every: Optional[str] = Query(None, description="Optional downsampling interval (e.g., '5m'): readings are averaged per stored geohash cell and interval server-side. Useful when zoomed out."),
     # Consider adding a limit parameter for raw points fetched?
     # raw_point_limit: int = Query(5000, gt=0, le=20000, description="Maximum raw points to fetch before aggregation.")
 ):
-    logger.info(f"Request for heatmap data: bbox=[{min_lat},{min_lon} to {max_lat},{max_lon}], zoom={zoom}, window={window}")
+    logger.info(f"Request for heatmap data: bbox=[{min_lat},{min_lon} to {max_lat},{max_lon}], zoom={zoom}, window={window}, every={every}")
 
     # Basic validation
     if min_lat >= max_lat or min_lon >= max_lon:
@@ -235,9 +246,10 @@ async def get_heatmap_data(
 
     # 1. Fetch raw points within the bounding box
     # Using a default limit defined in the db_client function for now
-    raw_readings = query_raw_points_in_bbox(
+    raw_readings = await run_in_threadpool(
+        query_raw_points_in_bbox,
         min_lat=min_lat, max_lat=max_lat, min_lon=min_lon, max_lon=max_lon,
-        window=window
+        window=window, aggregate_every=every
         # limit=raw_point_limit # Pass limit if added as query param
     )
 
@@ -260,6 +272,35 @@ async def get_heatmap_data(
     return aggregated_data
 
 
+# --- Endpoint for Recent Points (Columnar) ---
+@app.get(
+    f"{API_PREFIX}/air_quality/recent_points",
+    summary="Get Recent Points as Columns",
+    description="Returns the latest reading of each stored geohash cell in the time window as parallel arrays (timestamp, latitude, longitude, pm25, pm10, no2, so2, o3; missing values as null). Cheaper to build and parse than one object per point for map rendering."
+)
+async def get_recent_points_columnar(
+    limit: int = Query(50, gt=0, description="Maximum number of points to return."),
+    window: str = Query("1h", description="Time window to fetch data from (e.g., '1h', '24h', '15m'). Format: InfluxDB duration literal.")
+):
+    logger.info(f"Request for recent points (columnar): limit={limit}, window={window}")
+    try:
+        db_client.validate_recent_points_params(limit, window)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+    columns = await run_in_threadpool(query_recent_points_columnar, limit=limit, window=window)
+    if columns is None:
+        # Parameters were valid, so InfluxDB was unavailable or the query failed (logged by db_client)
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Failed to query recent points. The database may be temporarily unavailable."
+        )
+
+    logger.info(f"Returning {len(columns['timestamp'])} recent points (columnar).")
+    # Returned as a response directly: ORJSONResponse serializes the NumPy arrays itself (OPT_SERIALIZE_NUMPY)
+    return ORJSONResponse(content=columns)
+
+
 # --- Endpoint for Aggregated Points (Map View) ---
 @app.get(
     f"{API_PREFIX}/air_quality/pointsretired",
@@ -300,7 +341,7 @@ async def list_anomalies(
     if end_time and end_time.tzinfo is None:
         end_time = end_time.replace(tzinfo=timezone.utc)
 
-    anomalies = query_anomalies_from_db(start_time=start_time, end_time=end_time)
+    anomalies = await run_in_threadpool(query_anomalies_from_db, start_time=start_time, end_time=end_time)
     logger.info(f"Returning {len(anomalies)} anomalies.")
     return anomalies
 
@@ -330,7 +371,8 @@ async def get_pollution_density_for_bbox(
             detail="Invalid bounding box coordinates: min values must be less than max values."
         )
 
-    density_data = query_density_in_bbox(
+    density_data = await run_in_threadpool(
+        query_density_in_bbox,
         min_lat=min_lat, max_lat=max_lat, min_lon=min_lon, max_lon=max_lon, window=window
     )
 
@@ -372,7 +414,8 @@ async def get_air_quality_for_location(
     logger.info(f"Request received for specific location: lat={lat}, lon={lon}, precision={geohash_precision}, window={window}")
 
     # Call the updated database query function
-    data = query_latest_location_data(
+    data = await run_in_threadpool(
+        query_latest_location_data,
         lat=lat,
         lon=lon,
         precision=geohash_precision, # Pass the requested precision
@@ -424,7 +467,7 @@ async def get_location_history(
     
     # Convert coordinates to geohash
     try:
-        geohash_str = geohash.encode(lat, lon, precision=geohash_precision)
+        geohash_str = encode_geohash(lat, lon, geohash_precision)
         logger.debug(f"Converted coordinates ({lat},{lon}) to geohash: {geohash_str} with precision {geohash_precision}")
     except Exception as e:
         logger.error(f"Error encoding coordinates to geohash: {e}")
@@ -434,7 +477,8 @@ async def get_location_history(
         )
 
     # Call existing query function with the calculated geohash
-    history_data = query_location_history(
+    history_data = await run_in_threadpool(
+        query_location_history,
         geohash_str=geohash_str,
         parameter=parameter,
         window=window,
@@ -476,13 +520,14 @@ async def get_location_history_by_geohash(
             detail=f"Invalid parameter '{parameter}'. Valid parameters are: {', '.join(valid_parameters)}"
         )
     # Basic geohash validation (can be improved)
-    if not all(c in geohash.geohash.VALID_CHARS for c in geohash_str):
+    if not all(c in GEOHASH_BASE32 for c in geohash_str):
          raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=f"Invalid geohash string '{geohash_str}'."
         )
 
-    history_data = query_location_history(
+    history_data = await run_in_threadpool(
+        query_location_history,
         geohash_str=geohash_str,
         parameter=parameter,
         window=window,
@@ -553,7 +598,7 @@ async def websocket_endpoint(websocket: WebSocket):
         # --- Send recent anomalies ---
         try:
             # Query recent anomalies (e.g., last 10)
-            recent_anomalies = query_anomalies_from_db() 
+            recent_anomalies = await run_in_threadpool(query_anomalies_from_db) 
             logger.info(f"Fetched {len(recent_anomalies)} recent anomalies for client {connection_id}")
 
             if recent_anomalies:
@@ -614,7 +659,6 @@ async def test_anomaly_broadcast():
     logger.info("API: Creating and publishing test anomaly to broadcast exchange")
 
     # Create a test anomaly
-    import uuid
     test_anomaly = Anomaly(
         id=f"test_anomaly_{uuid.uuid4()}",
         latitude=36.88,
@@ -639,6 +683,15 @@ async def test_anomaly_broadcast():
         logger.error(f"API: Error publishing test anomaly: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Error publishing test anomaly: {str(e)}")
 
+# --- Debug Endpoint for In-Process Cache Statistics ---
+@app.get(
+    f"{API_PREFIX}/debug/cache_stats",
+    summary="In-Process Cache Statistics",
+    description="Returns hit/miss counters and sizes of the query and geohash caches of this API instance."
+)
+async def get_cache_stats():
+    return db_client.get_cache_stats()
+
 # --- Basic Root Endpoint ---
 @app.get("/", summary="Root Endpoint", description="Basic API information.")
 async def read_root():
@@ -2,7 +2,7 @@
 import asyncio
 import aio_pika
 import logging
-import json
+import orjson
 from contextlib import asynccontextmanager, AbstractAsyncContextManager
 from .config import get_settings
 from typing import AsyncGenerator
@@ -172,7 +172,7 @@ async def publish_message_async(message_body: dict):
                 # Publish the message
                 try:
                     message = aio_pika.Message(
-                        body=json.dumps(message_body).encode(),
+                        body=orjson.dumps(message_body), # orjson returns UTF-8 bytes directly
                         delivery_mode=aio_pika.DeliveryMode.PERSISTENT
                     )
                     await channel.default_exchange.publish(
@@ -242,7 +242,7 @@ async def publish_broadcast_message_async(message_body: dict):
                 # Publish the message to the fanout exchange (no routing key needed)
                 try:
                     message = aio_pika.Message(
-                        body=json.dumps(message_body).encode(),
+                        body=orjson.dumps(message_body), # orjson returns UTF-8 bytes directly
                         delivery_mode=aio_pika.DeliveryMode.PERSISTENT # Persist if queues are durable
                     )
                     await exchange.publish(message, routing_key="") # Empty routing key for fanout
@@ -29,11 +29,98 @@ settings = get_settings()
 RAW_DATA_QUEUE = settings.rabbitmq_queue_raw
 RABBITMQ_URL = f"amqp://{settings.rabbitmq_user}:{settings.rabbitmq_pass}@{settings.rabbitmq_host}:{settings.rabbitmq_port}/"
 PREFETCH_COUNT = 10 # How many messages the worker can process concurrently (tune as needed)
+WRITE_LINGER_SECONDS = 0.2 # How long a batch waits for more readings before it is written
+
+# --- Write Batching ---
+# The readings of concurrently processed messages go to InfluxDB in one request (write_air_quality_batch)
+# instead of one request each. A batch is written once PREFETCH_COUNT readings are waiting, or
+# WRITE_LINGER_SECONDS after its first one, and every message waits for its batch: it is only ACKed
+# once InfluxDB has stored the reading.
+class ReadingBatcher:
+    """ Collects readings from concurrent message handlers and writes them together. """
+    def __init__(self, max_size: int, linger_seconds: float):
+        self.max_size = max_size
+        self.linger_seconds = linger_seconds
+        self._pending = [] # (reading, future) in arrival order
+        self._timer = None
+        self._flushes = set() # Running flush tasks (referenced so they are not garbage collected)
+
+    async def write(self, reading: AirQualityReading) -> bool:
+        """ Adds the reading to the current batch; returns True once the batch is stored, False if it failed. """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((reading, future))
+        if len(self._pending) >= self.max_size:
+            self._flush_pending()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.linger_seconds, self._flush_pending)
+        return await future
+
+    def _flush_pending(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.get_running_loop().create_task(self._flush(batch))
+            self._flushes.add(task)
+            task.add_done_callback(self._flushes.discard)
+
+    async def _flush(self, batch):
+        readings = [reading for reading, _ in batch]
+        # Readings without any pollutant value are skipped by the writer, not failed
+        expected = sum(1 for r in readings if any(getattr(r, field) is not None for field in db_client.POLLUTANT_FIELDS))
+        try:
+            written = await asyncio.get_running_loop().run_in_executor(None, db_client.write_air_quality_batch, readings)
+            success = written == expected # One request per batch: all of it was stored, or none
+        except Exception as e:
+            logger.error(f"WORKER: Unexpected error writing a batch of {len(readings)} readings: {e}", exc_info=True)
+            success = False
+        if success:
+            # Before the messages are ACKed, as with single readings; a failure here does not fail them
+            await self._handle_anomalies(readings)
+        else:
+            logger.error(f"WORKER: Failed to write a batch of {len(readings)} readings to InfluxDB.")
+        for _, future in batch:
+            if not future.done(): # The handler may have been cancelled meanwhile
+                future.set_result(success)
+
+    async def _handle_anomalies(self, readings):
+        """ Checks the stored readings for anomalies, writes all of them in one request and broadcasts each. """
+        loop = asyncio.get_running_loop()
+        try:
+            anomalies = await loop.run_in_executor(
+                None, lambda: [a for a in map(anomaly_detection.check_thresholds, readings) if a]
+            )
+        except Exception as e:
+            logger.error(f"WORKER: Anomaly detection failed for a batch of {len(readings)} readings: {e}", exc_info=True)
+            return
+        if not anomalies:
+            logger.debug("WORKER: No threshold anomalies detected in batch.")
+            return
+        logger.info(f"WORKER: {len(anomalies)} anomalies detected in batch of {len(readings)} readings.")
+
+        # One request for every anomaly of the batch
+        written = await loop.run_in_executor(None, db_client.write_anomalies, anomalies)
+        if written != len(anomalies):
+            # Log error but don't fail the message processing just for this
+            logger.error(f"WORKER: Failed write for {len(anomalies)} detected anomalies: {[a.id for a in anomalies]}.")
+
+        # Publish each anomaly to the RabbitMQ fanout exchange for broadcasting
+        for anomaly in anomalies:
+            try:
+                if await publish_broadcast_message_async(anomaly.model_dump(mode='json')):
+                    logger.info(f"WORKER: Anomaly {anomaly.id} published to broadcast exchange successfully.")
+                else:
+                    # Log error but don't fail processing just for broadcast failure
+                    logger.error(f"WORKER: Failed to publish anomaly {anomaly.id} to broadcast exchange.")
+            except Exception as pub_error:
+                logger.error(f"WORKER: Error publishing anomaly {anomaly.id} to broadcast exchange: {pub_error}", exc_info=True)
+
+reading_batcher = ReadingBatcher(PREFETCH_COUNT, WRITE_LINGER_SECONDS)
 
 async def process_message(message: aio_pika.IncomingMessage):
     """Async callback function to process a message from the queue."""
-    # Get the current running loop to schedule executor tasks
-    loop = asyncio.get_running_loop()
     async with message.process(requeue=False, ignore_processed=True): # Context manager handles ack/nack based on exceptions
         logger.info(f"WORKER: Received message. Routing key: {message.routing_key}, Delivery tag: {message.delivery_tag}")
         data = None
@@ -75,56 +162,17 @@ async def process_message(message: aio_pika.IncomingMessage):
 
             # --- Execute Blocking DB/Anomaly Logic in Thread Pool Executor ---
 
-            # 4.1. Write data to InfluxDB (Offloaded)
-            logger.debug("WORKER: Attempting non-blocking write to InfluxDB...")
-            write_success = await loop.run_in_executor(
-                None,  # Use default ThreadPoolExecutor
-                db_client.write_air_quality_data,
-                reading
-            )
+            # 4.1. Write data to InfluxDB together with the other messages in flight (Offloaded)
+            logger.debug("WORKER: Adding reading to the current write batch...")
+            write_success = await reading_batcher.write(reading)
             if not write_success:
                 # Log the error, but context manager will NACK automatically on exit if needed
                 logger.error(f"WORKER: Failed write to InfluxDB for {reading.latitude},{reading.longitude}. Discarding (NACKing).")
                 # We still raise an exception here to ensure the context manager NACKs
                 raise IOError("Failed to write data to InfluxDB")
-            logger.debug("WORKER: Write to InfluxDB successful (offloaded).")
-
-            # 4.2. Perform Anomaly Detection (Offloaded)
-            logger.debug("WORKER: Checking non-blocking for anomalies...")
-            anomaly = await loop.run_in_executor(
-                None,
-                anomaly_detection.check_thresholds,
-                reading
-            )
-            if anomaly:
-                logger.info(f"WORKER: Anomaly detected (non-blocking check): {anomaly.description}") # Changed level to INFO
-                # 4.3. Write Anomaly if detected (Offloaded)
-                logger.debug("WORKER: Attempting non-blocking anomaly write...")
-                write_anomaly_success = await loop.run_in_executor(
-                    None,
-                    db_client.write_anomaly_data,
-                    anomaly
-                )
-                if not write_anomaly_success:
-                    # Log error but don't fail the original message processing just for this
-                    logger.error(f"WORKER: Failed write for detected anomaly {anomaly.id} (non-blocking).")
-                else:
-                    logger.debug("WORKER: Non-blocking anomaly write successful.")
-
-                # 4.4. Publish anomaly to RabbitMQ Fanout Exchange for broadcasting
-                logger.debug("WORKER: Publishing anomaly to broadcast exchange...")
-                try:
-                    # Use the new publish function for the fanout exchange
-                    broadcast_success = await publish_broadcast_message_async(anomaly.model_dump(mode='json'))
-                    if broadcast_success:
-                        logger.info(f"WORKER: Anomaly {anomaly.id} published to broadcast exchange successfully.")
-                    else:
-                        # Log error but don't fail processing just for broadcast failure
-                        logger.error(f"WORKER: Failed to publish anomaly {anomaly.id} to broadcast exchange.")
-                except Exception as pub_error:
-                    logger.error(f"WORKER: Error publishing anomaly {anomaly.id} to broadcast exchange: {pub_error}", exc_info=True)
-            else:
-                logger.debug("WORKER: No threshold anomalies detected (non-blocking check).")
+            logger.debug("WORKER: Write to InfluxDB successful (batched).")
+
+            # 4.2. Anomalies of the batch were detected, written and broadcast by the batcher before it returned
 
             # --- End Offloaded Block ---
 
@@ -0,0 +1,96 @@
+# backend/tests/test_flux_params.py
+# influxdb-client sends params={...} as top-level `option <key> = <literal>` statements (there is no
+# `params` record), so every identifier a query reads must be one of those options.
+import re
+from datetime import datetime, timezone
+
+import pytest
+from influxdb_client.client._base import _BaseQueryApi
+
+from app import db_client
+
+_COMMENT_RE = re.compile(r"//[^\n]*")
+_STRING_RE = re.compile(r'"(?:[^"\\]|\\.)*"')
+_REGEX_RE = re.compile(r"=~\s*/(?:[^/\\]|\\.)*/")
+# Bare identifiers starting with an underscore; r._value, r["_field"] etc. are columns, not variables
+_PARAM_IDENT_RE = re.compile(r"(?<![\w.])_[A-Za-z]\w*")
+
+class _RecordingQueryApi:
+    """ Stands in for the client's QueryApi: records every (query, params) and returns no rows. """
+    def __init__(self):
+        self.calls = []
+
+    def query_csv(self, query, org=None, dialect=None, params=None):
+        self.calls.append((query, params))
+        return iter([])
+
+    def query_stream(self, query, org=None, params=None):
+        self.calls.append((query, params))
+        return iter([])
+
+@pytest.fixture
+def recorded(monkeypatch):
+    api = _RecordingQueryApi()
+    monkeypatch.setattr(db_client, "client", object())
+    monkeypatch.setattr(db_client, "query_api", api)
+    monkeypatch.setattr(db_client, "_density_rollup_available", lambda: False)
+    for cache in (db_client._recent_points_cache, db_client._density_cache, db_client._anomaly_cache):
+        cache.clear()
+    return api.calls
+
+def assert_params_resolve(query: str, params: dict):
+    """ Every bare identifier the query reads must be declared by the options serialized from params. """
+    options = {statement.assignment.id.name for statement in _BaseQueryApi._build_flux_ast(params).body}
+    assert all(name.startswith("_") for name in options), options # Never shadow a Flux builtin
+    code = _REGEX_RE.sub("=~ //", _STRING_RE.sub('""', _COMMENT_RE.sub("", query)))
+    assert "params." not in code
+    referenced = set(_PARAM_IDENT_RE.findall(code))
+    assert referenced, "query reads no parameters"
+    assert referenced <= options, f"undeclared: {sorted(referenced - options)}"
+
+def assert_all_resolve(calls):
+    assert calls
+    for query, params in calls:
+        assert_params_resolve(query, params)
+
+@pytest.mark.parametrize("every", [None, "5m"])
+def test_raw_points_in_bbox_params(recorded, every):
+    db_client.query_raw_points_in_bbox(40.0, 41.0, 28.0, 29.0, window="1h", aggregate_every=every)
+    assert_all_resolve(recorded)
+
+def test_recent_points_params(recorded):
+    db_client.query_recent_points(limit=10, window="1h")
+    db_client.query_recent_points_columnar(limit=10, window="1h")
+    assert_all_resolve(recorded)
+
+@pytest.mark.parametrize("start_time, end_time", [
+    (None, None),
+    (datetime(2024, 1, 1, tzinfo=timezone.utc), datetime(2024, 1, 2, tzinfo=timezone.utc)),
+])
+def test_anomalies_params(recorded, start_time, end_time):
+    db_client.query_anomalies_from_db(start_time=start_time, end_time=end_time)
+    assert_all_resolve(recorded)
+
+def test_density_params(recorded):
+    db_client.query_density_in_bbox(40.0, 41.0, 28.0, 29.0, window="24h")
+    assert_all_resolve(recorded)
+
+def test_location_history_params(recorded):
+    db_client.query_location_history("sxk9", "pm25", window="24h", aggregate_window="10m")
+    assert_all_resolve(recorded)
+
+def test_latest_location_params(recorded):
+    # No row for the cell, so the 50 km radius estimate runs as well
+    db_client.query_latest_location_data(41.0, 29.0, 5, window="1h")
+    assert len(recorded) == 2
+    assert_all_resolve(recorded)
+
+def test_density_rollup_params(recorded, monkeypatch):
+    monkeypatch.setattr(db_client, "_density_rollup_available", lambda: True)
+    db_client.query_density_in_bbox(40.0, 41.0, 28.0, 29.0, window="7d")
+    assert "air_quality_density_geo5" in recorded[0][0]
+    assert_all_resolve(recorded)
+
+def test_rollup_state_params(recorded):
+    db_client._rollup_state()
+    assert_all_resolve(recorded)
@@ -0,0 +1,48 @@
+# backend/tests/test_geo.py
+# The built-in geohash encoders must produce exactly the tags python-geohash does inside the valid
+# range, and the same tags as each other everywhere, or bulk and single-point writes of the same
+# position would land in different series.
+import numpy as np
+import pytest
+
+from app.geo import encode_geohash, encode_geohashes
+
+PRECISIONS = (1, 4, 5, 8, 10, 12)
+
+@pytest.fixture(scope="module")
+def geohash():
+    return pytest.importorskip("geohash")
+
+@pytest.fixture(scope="module")
+def positions():
+    rng = np.random.default_rng(0)
+    lats = rng.uniform(-90.0, 90.0, 20_000)
+    lons = rng.uniform(-180.0, 180.0, 20_000)
+    # Edges: south pole, equator/prime meridian, antimeridian on both sides
+    lats[:4] = [-90.0, 0.0, 45.0, 12.5]
+    lons[:4] = [-180.0, 0.0, 180.0, -180.0]
+    return lats, lons
+
+@pytest.mark.parametrize("precision", PRECISIONS)
+def test_encode_geohashes_matches_geohash_encode(geohash, positions, precision):
+    lats, lons = positions
+    expected = [geohash.encode(lat, lon, precision) for lat, lon in zip(lats.tolist(), lons.tolist())]
+    assert encode_geohashes(lats, lons, precision) == expected
+
+@pytest.mark.parametrize("precision", PRECISIONS)
+def test_encode_geohash_matches_geohash_encode(geohash, positions, precision):
+    lats, lons = positions
+    for lat, lon in zip(lats[:2_000].tolist(), lons[:2_000].tolist()):
+        assert encode_geohash(lat, lon, precision) == geohash.encode(lat, lon, precision)
+
+# Outside geohash's [-90, 90) x [-180, 180) python-geohash versions disagree (some raise at lat == 90,
+# some clamp), so the edges are pinned here instead: the last row for lat == 90, wrap-around for lon == 180
+@pytest.mark.parametrize("lat, lon, expected", [
+    (90.0, 0.0, "upbpb"),
+    (0.0, 180.0, "80000"),
+    (90.0, 180.0, "bpbpb"),
+    (-90.0, -180.0, "00000"),
+])
+def test_encoders_agree_on_range_edges(lat, lon, expected):
+    assert encode_geohash(lat, lon, 5) == expected
+    assert encode_geohashes([lat], [lon], 5) == [expected]